@@ -1,18 +1,35 @@
 # -*- coding:utf-8 -*-
 
 from luma.core.interface.serial import spi
-from luma.core.render import canvas
-from luma.oled.device import sh1106
+from luma.oled.device import sh1106, ssd1306, ssd1309, ssd1322
 from gpiozero import Button
-from mpd import MPDClient
+from mpd import MPDClient, CommandError, ConnectionError as MPDConnectionError
 
 import time
 import subprocess
 import os
+import sys
+import select
+import re
+import bisect
+import random
+import json
+import argparse
 import threading
+import socket
+import signal
+import traceback
+import logging
+import logging.handlers
+from collections import deque
 
 from PIL import Image, ImageDraw, ImageFont
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # ビジュアライザは無効
+
 # GPIO定義
 RST_PIN = 25  # Reset
 CS_PIN = 8
@@ -28,8 +45,15 @@ BTN3_PIN = 16
 
 # 定数
 SCREEN_SAVER = 5.0  # 5sでスクリーンセーバー
-width = 128
-height = 64
+
+# 対応パネル（luma.oledのデバイス, 幅, 高さ, 4bitグレースケール）
+PANELS = {
+    "sh1106": (sh1106, 128, 64, False),
+    "ssd1306": (ssd1306, 128, 64, False),
+    "ssd1309": (ssd1309, 128, 64, False),
+    "ssd1322": (ssd1322, 256, 64, True),
+}
+DISPLAY = "sh1106"  # Waveshare 1.3inch OLED HAT
 
 # 画面状態
 STATE_OFF = 0
@@ -40,75 +64,1771 @@ STATE_LIBRARY = 4
 STATE_SYSTEM = 5
 STATE_QUEUE_MENU = 6
 STATE_QUEUE_MOVING = 7
+STATE_PLAYLIST_VIEW = 8
+STATE_PLAYLIST_MENU = 9
+STATE_ENQUEUE_MENU = 10
+STATE_ENQUEUE_PROGRESS = 11
+STATE_SERVER_SELECT = 12
+
+# コマンドライン引数
+parser = argparse.ArgumentParser(description="MPD client for Waveshare 1.3inch OLED HAT")
+parser.add_argument("--record", metavar="LOG", help="入力イベントとMPD通信をログに記録する")
+parser.add_argument("--replay", metavar="LOG", help="記録したログをヘッドレスで再生し、レイテンシを出力する")
+parser.add_argument("--headless", action="store_true", help="OLED/GPIOを使わずに実行する")
+parser.add_argument("--display", choices=sorted(PANELS), default=DISPLAY, help="接続しているOLEDパネル")
+parser.add_argument("--server", action="append", metavar="NAME=HOST[:PORT]",
+                    help="切り替えて操作するMPDサーバー（複数指定可、先頭が起動時の接続先）")
+parser.add_argument("--stall-threshold", type=float, default=3.0, metavar="SEC",
+                    help="メインループ・入力処理がこの秒数止まったら全スレッドのスタックを記録する（0で無効）")
+parser.add_argument("--stall-log", default="/var/log/mpd-client/stall.log", metavar="LOG",
+                    help="停止検出時のスタックの記録先（ローテーションあり）")
+parser.add_argument("--profile-dir", default="/var/log/mpd-client", metavar="DIR",
+                    help="プロファイル（SIGUSR1またはBTN1+BTN3で開始）の出力先")
+parser.add_argument("--profile-duration", type=float, default=30.0, metavar="SEC",
+                    help="プロファイルを採取する秒数（もう一度トリガーすると途中で終了）")
+args = parser.parse_args()
+headless = args.headless or args.replay is not None
+panel_class, width, height, greyscale = PANELS[args.display]
+
+# 記録ログ（--record時のみ有効）
+trace_file = None
+trace_lock = threading.Lock()
+trace_start = time.time()
+
+def trace(event, **fields):
+    """記録ログに1イベントを書き込む"""
+    if trace_file is None:
+        return
+    fields["ev"] = event
+    fields["t"] = round(time.time() - trace_start, 4)
+    line = json.dumps(fields, ensure_ascii=False, default=str)
+    with trace_lock:
+        trace_file.write(line + "\n")
+
+class RecordingMPDClient:
+    """MPDClientのラッパー（全コマンドと応答を記録）"""
+
+    def __init__(self):
+        object.__setattr__(self, "_client", MPDClient())
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*cmd_args, **cmd_kwargs):
+            t0 = time.perf_counter()
+            try:
+                result = attr(*cmd_args, **cmd_kwargs)
+            except Exception as e:
+                trace("mpd", cmd=name, args=list(cmd_args), error=type(e).__name__, msg=str(e),
+                      dt=round((time.perf_counter() - t0) * 1000, 2))
+                raise
+            trace("mpd", cmd=name, args=list(cmd_args), result=result,
+                  dt=round((time.perf_counter() - t0) * 1000, 2))
+            return result
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+def stub_key(cmd, cmd_args):
+    """記録ログの応答を探すキー（コマンド名と、記録時と同じくJSONにした引数）"""
+    return (cmd, json.dumps(list(cmd_args), ensure_ascii=False, default=str))
+
+class StubMPDClient:
+    """記録ログの応答を返すMPDClientの代役（再生用）
+
+    コマンド名と引数が同じ記録のうち、再生中の時刻までに記録された最新の応答を返す
+    （その時刻より前の記録がなければ最初の応答）。呼び出し回数が記録時と違うバージョンでも
+    同じ時点のMPDの状態が返る。記録にない引数の呼び出しは、そのコマンドが値を返さない
+    操作なら None、そうでなければ CommandError にする。返した応答の記録時の所要時間（dt）は
+    mpd_ms に積算する（再生時は実際には待たないため、レイテンシに加算する）。
+    """
+
+    def __init__(self, events, clock):
+        self._clock = clock
+        self._responses = {}  # (コマンド, 引数) -> ([記録時刻], [イベント])
+        self._results = {}  # コマンド -> 値を返したことがあるか
+        self.calls = 0
+        self.mpd_ms = 0.0  # 返した応答の記録時の所要時間の合計
+        for ev in events:
+            if ev["ev"] == "mpd":
+                times, evs = self._responses.setdefault(stub_key(ev["cmd"], ev.get("args", [])), ([], []))
+                times.append(ev["t"])
+                evs.append(ev)
+                if ev.get("result") is not None:
+                    self._results[ev["cmd"]] = True
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*cmd_args, **cmd_kwargs):
+            self.calls += 1
+            recorded = self._responses.get(stub_key(name, cmd_args))
+            if recorded is None:
+                if self._results.get(name):
+                    raise CommandError(f"[5@0] {{{name}}} not in the recorded log: {list(cmd_args)}")
+                return None
+            times, evs = recorded
+            ev = evs[max(0, bisect.bisect_right(times, self._clock()) - 1)]
+            self.mpd_ms += ev.get("dt", 0.0)
+            if "error" in ev:
+                if ev["error"] == "ConnectionError":
+                    raise MPDConnectionError(ev["msg"])
+                raise CommandError(ev["msg"])
+            return ev.get("result")
+        return call
+
+# 停止監視（メインループ・入力処理・MPDワーカーの処理中の箇所と開始時刻を記録）
+STALL_THRESHOLD = args.stall_threshold
+STALL_LOG_BYTES = 256 * 1024
+STALL_LOG_BACKUPS = 3
+watch_entries = {}  # 名前 -> (処理内容, 開始時刻, 停止とみなす秒数)
+stall_logger = logging.getLogger("mpd-client.stall")
+
+def watch_begin(name, label, limit=None):
+    """処理の開始を記録（メインループは1周ごとに呼んでハートビートとする）"""
+    watch_entries[name] = (label, time.monotonic(), STALL_THRESHOLD if limit is None else limit)
+
+def watch_end(name):
+    """処理の終了を記録"""
+    watch_entries.pop(name, None)
+
+def sd_notify(message):
+    """systemdへ状態を通知（NOTIFY_SOCKETがない場合は何もしない）"""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]  # 抽象名前空間
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode(), address)
+    except OSError:
+        pass
+
+def open_stall_log(path):
+    """停止ログの出力先を設定（書き込めない場合は標準エラー = journal）"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=STALL_LOG_BYTES,
+                                                       backupCount=STALL_LOG_BACKUPS, encoding="utf-8")
+    except OSError:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    stall_logger.addHandler(handler)
+    stall_logger.setLevel(logging.INFO)
+    stall_logger.propagate = False
+
+def dump_stall(stalled, now):
+    """停止中の処理と全スレッドのスタックを記録"""
+    lines = ["stall detected: " + ", ".join(f"{name} [{label}] {now - t:.1f}s" for name, label, t in stalled)]
+    for name, (label, t, limit) in sorted(watch_entries.items()):
+        lines.append(f"  {name}: {label} ({now - t:.2f}s / {limit:.1f}s)")
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident == threading.get_ident():
+            continue
+        lines.append(f"--- thread {names.get(ident, ident)}")
+        lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+    stall_logger.warning("\n".join(lines))
+
+def stall_watchdog():
+    """停止監視スレッド（閾値を超えたら1回だけスタックを記録し、正常な間はsystemdへWATCHDOG=1を送る）"""
+    watchdog_usec = int(os.environ.get("WATCHDOG_USEC", "0") or 0)
+    notify_interval = watchdog_usec / 2e6 if watchdog_usec else None
+    interval = min(STALL_THRESHOLD / 4 if STALL_THRESHOLD > 0 else 1.0, notify_interval or 1.0)
+    last_notify = 0.0
+    reported = {}  # 名前 -> 記録済みの開始時刻
+
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        stalled = []
+        for name, (label, t, limit) in list(watch_entries.items()):
+            if limit > 0 and now - t > limit:
+                stalled.append((name, label, t))
+        new = [entry for entry in stalled if reported.get(entry[0]) != entry[2]]
+        if new:
+            dump_stall(stalled, now)
+        # 止まっていた処理が再開したら停止時間を記録
+        for name, t in list(reported.items()):
+            current = watch_entries.get(name)
+            if current is None or current[1] != t:
+                stall_logger.warning(f"stall recovered: {name} after {now - t:.1f}s")
+                del reported[name]
+        for name, label, t in stalled:
+            reported[name] = t
+
+        # メインループが止まっている間はsystemdへの通知を止める（WatchdogSec経過で再起動される）
+        main = watch_entries.get("main")
+        healthy = main is not None and now - main[1] <= max(STALL_THRESHOLD, interval * 2)
+        if notify_interval and healthy and now - last_notify >= notify_interval:
+            sd_notify("WATCHDOG=1")
+            last_notify = now
+
+# プロファイラ（全スレッドのスタックを一定間隔で採取。cProfileと違い全スレッドを低負荷で見られる）
+PROFILE_DIR = args.profile_dir
+PROFILE_DURATION = args.profile_duration
+PROFILE_INTERVAL = 0.01  # 採取間隔（秒）
+PROFILE_TOP = 15  # 要約に載せる関数の数（スレッドごと）
+PROFILE_BADGE = "profiling…"
+profiler = None
+
+class SamplingProfiler:
+    """一定時間、全スレッドのスタックを採取して集計する"""
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.stop = threading.Event()
+        self.running = True
+        self.started = time.time()
+        self.samples = 0
+        self.stacks = {}  # (スレッド名, (関数名, ファイル名, 関数の行, 実行中の行), ...) -> 採取回数
+
+    def run(self):
+        """採取スレッド（時間切れか停止要求で終了し、結果をファイルに書き出す）"""
+        global data_ready
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while not self.stop.wait(PROFILE_INTERVAL) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, os.path.basename(code.co_filename), code.co_firstlineno, frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+        self.running = False
+        self.write()
+        data_ready = True
+
+    def write(self):
+        """集計をflamegraph用の折り畳み形式（.folded）と、スレッドごとの要約（.txt）に書き出す"""
+        base = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started)))
+        elapsed = time.time() - self.started
+        # スレッドごとの採取回数と、関数ごとの累積（スタック中に出現）・行ごとの自己（最深部で実行中）の回数
+        threads = {}
+        folded = []
+        for key, count in self.stacks.items():
+            name, frames = key[0], key[1:]
+            folded.append(";".join([name] + [f"{func} ({file}:{line})" for func, file, first, line in frames]) + f" {count}")
+            entry = threads.setdefault(name, [0, {}, {}])
+            entry[0] += count
+            for func, file, first, line in set(frames):
+                label = f"{func} ({file}:{first})"
+                entry[1][label] = entry[1].get(label, 0) + count
+            if frames:
+                func, file, first, line = frames[-1]
+                label = f"{func} ({file}:{line})"
+                entry[2][label] = entry[2].get(label, 0) + count
+        lines = [f"# {self.samples} samples in {elapsed:.1f}s (interval {PROFILE_INTERVAL * 1000:.0f}ms)"]
+        for name, (total, cumulative, own) in sorted(threads.items()):
+            lines.append(f"\n== {name} ({total} samples)")
+            lines.append(" cumul  function")
+            for label, count in sorted(cumulative.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+                lines.append(f"{count * 100 / total:5.1f}%  {label}")
+            lines.append("  self  line")
+            for label, count in sorted(own.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+                lines.append(f"{count * 100 / total:5.1f}%  {label}")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                f.write("\n".join(sorted(folded)) + "\n")
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            print(f"profile written: {base}.folded, {base}.txt", file=sys.stderr)
+        except OSError as e:
+            print("profile write failed:", e, file=sys.stderr)
+
+def profiling():
+    return profiler is not None and profiler.running
+
+def toggle_profile():
+    """プロファイルを開始（採取中なら途中で終了して書き出す）"""
+    global profiler, data_ready
+    if profiling():
+        profiler.stop.set()
+    else:
+        profiler = SamplingProfiler(PROFILE_DURATION)
+        threading.Thread(target=profiler.run, name="profiler", daemon=True).start()
+    data_ready = True
+
+# MPD 0.24で追加されたコマンド（python-mpd2が未対応の場合に登録）
+if not hasattr(MPDClient, "playlistlength"):
+    MPDClient.add_command("playlistlength", MPDClient._parse_object)
 
 # MPDクライアント初期化
-mpd_client = MPDClient()
-mpd_connected = False
+mpd_client_factory = RecordingMPDClient if args.record else MPDClient
 
 # MPD接続設定
 MPD_HOST = "localhost"
 MPD_PORT = 6600
-
-def connect_mpd():
-    """MPDに接続（接続確認と自動再接続）"""
-    global mpd_client, mpd_connected
+MPD_SERVERS = [("ローカル", MPD_HOST, MPD_PORT)]  # (名前, ホスト, ポート[, 音楽ディレクトリ])、--serverで置き換え
+MUSIC_DIRECTORY = "/home/pi/Music"  # mpd.confのmusic_directory（このマシンのMPDの.lrcを直接読む）
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+MPD_TIMEOUT = 5.0  # 接続・応答待ちのタイムアウト（秒）
+MPD_RETRY_BASE = 1.0  # 接続に失敗したサーバーへの再接続間隔（失敗するごとに倍）
+MPD_RETRY_MAX = 60.0
+MPD_IDLE_TIMEOUT = 60.0  # idleで変更がないままこの時間が過ぎたら接続を張り直す
+MPD_IDLE_SUBSYSTEMS = ("player", "mixer", "options", "playlist", "stored_playlist")
+MPD_COMMAND_DEADLINE = 3.0  # コマンド投入から実行開始までの期限（秒）
+PLAYLIST_PAGE = 32  # プレイリスト閲覧時に一度に取得する曲数
+BUSY_INDICATOR_DELAY = 0.3  # この時間以上MPDの応答待ちが続いたらビジー表示
+
+def new_mpd_cache():
+    """MPD状態キャッシュ（ワーカーとidleスレッドが更新し、描画はここから読む）"""
+    return {
+        "status": {},
+        "current": {},
+        "playlist": [],
+        "playlist_version": None,
+        "library": (None, []),  # (パス, lsinfoの結果)
+        "playlist_window": (None, 0, []),  # (プレイリスト名, 先頭位置, 表示範囲付近の曲)
+        "playlist_length": (None, None),  # (プレイリスト名, 曲数)（不明な場合はNone）
+        "playlist_files": (None, []),  # (プレイリスト名, 全曲のファイル)（範囲指定に未対応のMPD用）
+        "error": None,
+        "status_time": 0.0,  # statusを取得した時刻（経過時間の補間用）
+        "genres": None,  # ライブラリのジャンル一覧（一括追加用）
+    }
+
+class MPDServer:
+    """接続先のMPDサーバー（ワーカーの接続、状態キャッシュ、再接続の間隔をサーバーごとに持つ）"""
+
+    def __init__(self, name, host, port, music_directory=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        # .lrcを直接読むディレクトリ（省略時、このマシンのMPDならMUSIC_DIRECTORY、それ以外は読まない）
+        if music_directory is None and (host in LOCAL_HOSTS or host.startswith("/")):
+            music_directory = MUSIC_DIRECTORY
+        self.music_directory = music_directory
+        self.client = None
+        self.connected = False
+        self.cache = new_mpd_cache()
+        self.failures = 0  # 連続して接続に失敗した回数
+        self.next_retry = 0.0  # この時刻までは接続を試みない
+        self.watching = False  # idleで変更を待ち受け中（状態とキューのキャッシュが最新）
+        self.ranged_playlists = True  # listplaylistinfoの範囲指定に対応（MPD 0.24以上）
+        self.jobs = deque()  # 未実行のコマンド（サーバーごとのワーカーが順に実行）
+        self.running_job = None
+
+    def connect_failed(self):
+        """接続の失敗を記録し、次に接続を試みる時刻を延ばす"""
+        self.failures += 1
+        self.next_retry = time.time() + min(MPD_RETRY_MAX, MPD_RETRY_BASE * 2 ** (self.failures - 1))
+
+    def connect_succeeded(self):
+        self.failures = 0
+        self.next_retry = 0.0
+
+def parse_server(spec):
+    """--serverの値（名前=ホスト[:ポート]）を (名前, ホスト, ポート) に変換"""
+    name, _, address = spec.rpartition("=")
+    host, _, port = address.partition(":")
+    return (name or host, host, int(port) if port else 6600)
+
+if args.server:
+    MPD_SERVERS = [parse_server(spec) for spec in args.server]
+mpd_servers = [MPDServer(*spec) for spec in MPD_SERVERS]
+active_server = mpd_servers[0]  # 操作・表示の対象
+mpd_cache = active_server.cache  # 表示中のサーバーのキャッシュ（切り替え時に差し替え）
+data_ready = False  # キャッシュ更新による再描画要求
+
+def connect_mpd(server):
+    """MPDに接続（接続確認と自動再接続。失敗が続くサーバーは間隔を空けて再接続）"""
     try:
-        if mpd_connected:
+        if server.connected:
             # 接続が生きているか確認
             try:
-                mpd_client.ping()
+                server.client.ping()
                 return
             except:
                 # 接続が切れている
-                mpd_connected = False
+                server.connected = False
 
         # 再接続が必要
         try:
-            mpd_client.disconnect()
+            server.client.disconnect()
         except:
             pass
 
+        # 接続できなかったサーバーは待ち時間が過ぎるまで試みない（エラーはUI側で表示）
+        if time.time() < server.next_retry:
+            return
+
         # 新しいクライアントで接続
-        mpd_client = MPDClient()
-        mpd_client.connect(MPD_HOST, MPD_PORT)
-        mpd_connected = True
+        server.client = mpd_client_factory()
+        server.client.connect(server.host, server.port, timeout=MPD_TIMEOUT)
+        server.connected = True
+        server.connect_succeeded()
 
     except Exception as e:
-        mpd_connected = False
+        server.connected = False
+        server.connect_failed()
         # エラーを無視（UI側でエラー処理）
 
 def disconnect_mpd():
-    global mpd_client, mpd_connected
+    for server in mpd_servers:
+        try:
+            if server.connected:
+                server.client.close()
+                server.client.disconnect()
+                server.connected = False
+        except:
+            pass
+
+class MPDJob:
+    """MPDワーカーで実行するコマンド（投入時に表示中のサーバーに対して実行）"""
+
+    def __init__(self, func, key, deadline, on_done, on_drop):
+        self.func = func
+        self.key = key
+        self.server = active_server
+        self.submitted = time.time()
+        self.deadline = self.submitted + deadline
+        self.on_done = on_done
+        self.on_drop = on_drop  # 実行せずに破棄した（取り消し・期限切れ）場合に呼ぶ
+        self.cancelled = False
+
+# MPDコマンドキュー（サーバーごとにキューとワーカーを持つ。表示していないサーバーの
+# コマンドや再接続待ちが、表示中のサーバーの操作を遅らせないようにする）
+mpd_jobs_cond = threading.Condition()
+mpd_local = threading.local()  # このスレッドで実行中のコマンド
+
+def mpd_submit(func, key=None, deadline=MPD_COMMAND_DEADLINE, on_done=None, on_drop=None):
+    """MPDコマンドを表示中のサーバーのワーカーに投入（同じキーの未実行コマンドは破棄）"""
+    job = MPDJob(func, key, deadline, on_done, on_drop)
+    with mpd_jobs_cond:
+        if key is not None:
+            for queued in job.server.jobs:
+                if queued.key == key:
+                    queued.cancelled = True
+        job.server.jobs.append(job)
+        mpd_jobs_cond.notify_all()
+    return job
+
+def mpd_cancel(key):
+    """指定キーの未実行・実行中のコマンドを全サーバーで取り消す（実行中の結果は破棄）"""
+    with mpd_jobs_cond:
+        for server in mpd_servers:
+            for queued in server.jobs:
+                if queued.key == key:
+                    queued.cancelled = True
+            if server.running_job is not None and server.running_job.key == key:
+                server.running_job.cancelled = True
+
+def mpd_is_busy():
+    """表示中のサーバーの応答待ちが一定時間以上続いているか"""
+    limit = time.time() - BUSY_INDICATOR_DELAY
+    with mpd_jobs_cond:
+        running = active_server.running_job
+        if running is not None and running.submitted < limit:
+            return True
+        return any(not job.cancelled and job.submitted < limit for job in active_server.jobs)
+
+def running_job():
+    """このスレッドで実行中のコマンド"""
+    return mpd_local.job
+
+def job_cache():
+    """ワーカーで実行中のコマンドの対象サーバーのキャッシュ"""
+    return running_job().server.cache
+
+def mpd_take_job(server, block=True):
+    """サーバーの次に実行するコマンドを取り出す（blockしない場合、なければNone）"""
+    with mpd_jobs_cond:
+        while True:
+            while not server.jobs:
+                if not block:
+                    return None
+                mpd_jobs_cond.wait()
+            job = server.jobs.popleft()
+            if job.cancelled and job.on_drop is None:
+                mpd_jobs_cond.notify_all()
+                continue
+            # 取り消されたコマンドも破棄時の処理があれば渡す（実行はしない）
+            server.running_job = job
+            mpd_local.job = job
+            return job
+
+def mpd_execute(job):
+    """コマンドを実行して完了処理を呼ぶ"""
+    result = None
+    error = None
+    remaining = job.deadline - time.time()
+    server = job.server
+    if job.cancelled:
+        pass
+    elif remaining <= 0:
+        # 期限切れ（MPDが詰まっている間に古くなったコマンド）は送らない
+        job.cancelled = True
+    else:
+        # ソケットのタイムアウトより長く戻らない場合に停止として記録
+        watch_begin(f"mpd-worker-{server.name}", job.key or getattr(job.func, "__name__", "job"),
+                    MPD_TIMEOUT + STALL_THRESHOLD if STALL_THRESHOLD > 0 else 0)
+        try:
+            if not server.connected:
+                connect_mpd(server)
+            if not server.connected:
+                raise MPDConnectionError(f"{server.name}に接続できません")
+            result = job.func(server.client)
+        except CommandError as e:
+            error = e
+        except Exception as e:
+            # タイムアウト等で応答が途中の可能性があるため、次回は再接続
+            server.connected = False
+            error = e
+        finally:
+            watch_end(f"mpd-worker-{server.name}")
+
+    callback = job.on_drop if job.cancelled else job.on_done
+    if callback is not None:
+        try:
+            if job.cancelled:
+                callback()
+            else:
+                callback(result, error)
+        except Exception:
+            pass
+
+    with mpd_jobs_cond:
+        server.running_job = None
+        mpd_local.job = None
+        mpd_jobs_cond.notify_all()
+
+def mpd_worker(server):
+    """サーバーのMPDコマンドを順に実行するワーカースレッド"""
+    while True:
+        mpd_execute(mpd_take_job(server))
+
+def mpd_run_pending():
+    """投入済みのコマンドを呼び出し元のスレッドで順に実行（記録ログの再生用。完了処理で追加されたものも含む）"""
+    while True:
+        for server in mpd_servers:
+            job = mpd_take_job(server, block=False)
+            if job is not None:
+                mpd_execute(job)
+                break
+        else:
+            return
+
+# 楽観的更新（MPDへの反映待ちの値。描画はMPDの状態にこれを重ねて行う）
+OPTIMISTIC_DEBOUNCE = 0.4  # 最後の操作からMPDへ送るまでの待ち時間（秒、ボタンの連打間隔より長く）
+OPTIMISTIC_EXPIRE = MPD_COMMAND_DEADLINE + MPD_TIMEOUT  # 送信後この時間で反映を諦める
+optimistic = {}  # フィールド名 -> {"value", "base", "changed", "generation", "sent"}
+optimistic_lock = threading.Lock()
+
+def effective_status():
+    """MPDの状態に反映待ちの操作を重ねた状態"""
+    status = mpd_cache["status"]
+    with optimistic_lock:
+        if not optimistic:
+            return status
+        merged = dict(status)
+        for field, entry in optimistic.items():
+            merged[field] = entry["value"]
+    return merged
+
+def optimistic_set(field, value):
+    """状態を即座に変更し、MPDへの送信を予約"""
+    with optimistic_lock:
+        entry = optimistic.get(field)
+        if entry is None:
+            base = mpd_cache["status"].get(field)
+            generation = 1
+        else:
+            # 送信済みなら、その値が反映された状態を起点にする
+            base = entry["value"] if entry["sent"] else entry["base"]
+            generation = entry["generation"] + 1
+        optimistic[field] = {"value": value, "base": base, "changed": clock(),
+                             "generation": generation, "sent": False}
+
+def flush_optimistic(force=False):
+    """操作が落ち着いた項目（forceならすべて）をまとめて1回のコマンドでMPDへ送る"""
+    now = clock()
+    with optimistic_lock:
+        for field in [f for f, e in optimistic.items() if e["sent"] and now - e["changed"] > OPTIMISTIC_EXPIRE]:
+            del optimistic[field]
+        ready = {f: dict(e) for f, e in optimistic.items()
+                 if not e["sent"] and (force or now - e["changed"] >= OPTIMISTIC_DEBOUNCE)}
+        for field in ready:
+            optimistic[field]["sent"] = True
+    if not ready:
+        return
+
+    def run(client):
+        status = client.status()
+        if 'volume' in ready:
+            # 操作中の変化量をMPDの現在値に適用
+            entry = ready['volume']
+            volume = int(status.get('volume', -1))
+            if volume >= 0:
+                delta = int(entry["value"]) - int(entry["base"] or volume)
+                if delta:
+                    client.setvol(max(0, min(100, volume + delta)))
+        if 'state' in ready and status.get('state') != ready['state']["value"]:
+            if ready['state']["value"] == 'pause':
+                client.pause(1)
+            else:
+                client.play()
+        for field in ('repeat', 'single', 'random'):
+            if field in ready and status.get(field) != ready[field]["value"]:
+                getattr(client, field)(int(ready[field]["value"]))
+        # MPDの状態と照合
+        fetch_status(client)
+
+    def done(result, error):
+        # 送信後に変更されていない項目はMPDの状態を正とする
+        with optimistic_lock:
+            for field, entry in ready.items():
+                current = optimistic.get(field)
+                if current is not None and current["generation"] == entry["generation"]:
+                    del optimistic[field]
+        refresh_done(result, error)
+
+    def dropped():
+        # 期限切れで送らなかった: 推測の値は捨て、MPDの状態を取り直す
+        done(None, None)
+        request_refresh()
+
+    mpd_submit(run, on_done=done, on_drop=dropped)
+
+def refresh_done(result, error):
+    """状態取得の完了（キャッシュ更新を通知）"""
+    global data_ready
+    job_cache()["error"] = str(error) if error is not None else None
+    data_ready = True
+
+def command_done(result, error):
+    """操作コマンドの完了（表示中の画面の状態を取り直す）"""
+    if error is not None:
+        refresh_done(result, error)
+    request_refresh()
+
+def mpd_command(func):
+    """操作コマンドをワーカーに投入"""
+    return mpd_submit(func, on_done=command_done)
+
+def fetch_status(client):
+    """再生状態と再生中の曲を取得"""
+    cache = job_cache()
+    cache["status"] = client.status()
+    cache["status_time"] = time.time()
+    cache["current"] = client.currentsong()
+    # 履歴は通常idleスレッドが記録する（待ち受けていない場合のみここで補う）
+    if not running_job().server.watching:
+        note_played(cache["current"].get('file'))
+
+def fetch_queue(client):
+    """再生状態と再生キューを取得（キューは変更があった場合のみ）"""
+    cache = job_cache()
+    status = client.status()
+    if status.get('playlist') != cache["playlist_version"]:
+        cache["playlist"] = client.playlistinfo()
+        cache["playlist_version"] = status.get('playlist')
+    cache["status"] = status
+    cache["status_time"] = time.time()
+
+def clear_playlist_cache(cache):
+    """保存済みプレイリストの取得結果を破棄（開き直したとき・変更の通知を受けたとき）"""
+    cache["playlist_window"] = (None, 0, [])
+    cache["playlist_length"] = (None, None)
+    cache["playlist_files"] = (None, [])
+
+def fetch_playlist_window(name, start):
+    """保存済みプレイリストの一部（start から PLAYLIST_PAGE 曲）を取得"""
+    def fetch(client):
+        server = running_job().server
+        cache = server.cache
+        end = start + PLAYLIST_PAGE
+        items = None
+        if server.ranged_playlists:
+            if cache["playlist_length"][0] != name:
+                try:
+                    length = int(client.playlistlength(name)['songs'])
+                except CommandError:
+                    length = None  # MPD 0.24未満
+                cache["playlist_length"] = (name, length)
+            try:
+                items = client.listplaylistinfo(name, f"{start}:{end}")
+            except CommandError:
+                # 範囲指定に未対応のMPD: 範囲なしで取得できれば以後は範囲指定を試さない
+                cache["playlist_files"] = (name, client.listplaylist(name))
+                server.ranged_playlists = False
+
+        if items is None:
+            # ファイル一覧（1回だけ取得）から表示範囲付近を切り出す
+            if cache["playlist_files"][0] != name:
+                cache["playlist_files"] = (name, client.listplaylist(name))
+            files = cache["playlist_files"][1]
+            cache["playlist_length"] = (name, len(files))
+            items = [{'file': file} for file in files[start:end]]
+
+        # 要求より少なければ末尾に到達している
+        if cache["playlist_length"][1] is None and len(items) < PLAYLIST_PAGE:
+            cache["playlist_length"] = (name, start + len(items))
+        cache["playlist_window"] = (name, start, items)
+    return fetch
+
+def request_refresh():
+    """表示中の画面に必要なMPD状態の再取得を要求（古い要求は破棄）"""
+    if state != STATE_PLAYLIST_VIEW and state != STATE_PLAYLIST_MENU and mpd_cache["playlist_files"][0] is not None:
+        # 閲覧を終えたらファイル一覧（範囲指定に未対応のMPD用）は手放す
+        mpd_cache["playlist_files"] = (None, [])
+    if state == STATE_PLAYING:
+        # 反映待ちの操作がある間は取らない（送信時のジョブがstatusを取り直して照合する）
+        with optimistic_lock:
+            if optimistic:
+                return
+        mpd_submit(fetch_status, key="refresh", on_done=refresh_done)
+    elif state == STATE_QUEUE or state == STATE_QUEUE_MENU:
+        # idleで待ち受け中ならキャッシュは最新
+        if not active_server.watching:
+            mpd_submit(fetch_queue, key="refresh", on_done=refresh_done)
+    elif state == STATE_LIBRARY:
+        path = "/".join(library_path) if library_path else ""
+
+        def fetch_library(client):
+            cache = job_cache()
+            listing = (path, client.lsinfo(path))
+            # 内容が同じなら差し替えない（画面の依存判定を変えないため）
+            if listing != cache["library"]:
+                cache["library"] = listing
+        mpd_submit(fetch_library, key="refresh", on_done=refresh_done)
+    elif state == STATE_PLAYLIST_VIEW or state == STATE_PLAYLIST_MENU:
+        # カーソル付近が取得済みの範囲内なら取得しない
+        name, start, items = mpd_cache["playlist_window"]
+        first = max(0, playlist_cursor - layout.list_lines)
+        last = playlist_cursor + layout.list_lines
+        length = playlist_length()
+        if length is not None:
+            last = min(last, length - 1)
+        if name == playlist_name and start <= first and last < start + len(items):
+            return
+        if name == playlist_name and length is not None and length == 0:
+            return
+        start = max(0, playlist_cursor - PLAYLIST_PAGE // 2)
+        mpd_submit(fetch_playlist_window(playlist_name, start), key="refresh", on_done=refresh_done)
+    elif state == STATE_ENQUEUE_MENU and mpd_cache["genres"] is None:
+        mpd_submit(fetch_genres, key="refresh", on_done=refresh_done)
+
+def fetch_genres(client):
+    """ライブラリのジャンル一覧を取得"""
+    genres = []
+    for item in client.list("genre"):
+        genre = item.get('genre') if isinstance(item, dict) else item
+        if genre:
+            genres.append(genre)
+    job_cache()["genres"] = genres
+
+def idle_fetch(server, client, changed):
+    """idleで通知された変更に応じてサーバーのキャッシュを更新（Noneはすべて取得）"""
+    cache = server.cache
+    status = client.status()
+    if changed is None or "player" in changed:
+        cache["current"] = client.currentsong()
+        # 表示中の画面に関係なく曲の変化を受け取れるので、再生履歴はここで記録する
+        if server is active_server:
+            note_played(cache["current"].get('file'))
+    version = status.get('playlist')
+    if (changed is None or "playlist" in changed) and version != cache["playlist_version"]:
+        if cache["playlist_version"] is None:
+            playlist = client.playlistinfo()
+        else:
+            # 前回からの変更分だけ取得して反映
+            playlist = list(cache["playlist"])
+            for song in client.plchanges(cache["playlist_version"]):
+                pos = int(song['pos'])
+                if pos < len(playlist):
+                    playlist[pos] = song
+                else:
+                    playlist.append(song)
+            del playlist[int(status.get('playlistlength', 0)):]
+        cache["playlist"] = playlist
+        cache["playlist_version"] = version
+    if changed is not None and "stored_playlist" in changed:
+        # 保存済みプレイリストが変更された（閲覧中なら取り直す）
+        clear_playlist_cache(cache)
+        if server is active_server and (state == STATE_PLAYLIST_VIEW or state == STATE_PLAYLIST_MENU):
+            request_refresh()
+    cache["status"] = status
+    cache["status_time"] = time.time()
+    cache["error"] = None
+
+def idle_watch(server):
+    """サーバーの状態とキューのキャッシュをidleで最新に保つスレッド（専用の接続を使う）"""
+    global data_ready
+    while True:
+        wait = server.next_retry - time.time()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+        client = MPDClient()  # 記録ログには残さない
+        client.idletimeout = MPD_IDLE_TIMEOUT
+        try:
+            client.connect(server.host, server.port, timeout=MPD_TIMEOUT)
+            server.connect_succeeded()
+            changed = None
+            while True:
+                idle_fetch(server, client, changed)
+                server.watching = True
+                if server is active_server or state == STATE_SERVER_SELECT:
+                    data_ready = True
+                try:
+                    changed = client.idle(*MPD_IDLE_SUBSYSTEMS)
+                except socket.timeout:
+                    break  # 変更なし。張り直して状態を取り直す
+        except Exception:
+            server.connect_failed()
+        finally:
+            server.watching = False
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+def switch_server(server):
+    """操作・表示の対象を切り替え（キャッシュは待ち受け中に更新済みなので即座に描画できる）"""
+    global active_server, mpd_cache, last_song_id, playing_header_valid, lyrics_requested
+    global library_path, library_cursor, library_scroll, queue_cursor, queue_moving_from
+    if server is active_server:
+        return
+    # 反映待ちの操作は元のサーバーへ送ってから切り替える
+    flush_optimistic(force=True)
+    with optimistic_lock:
+        optimistic.clear()
+    mpd_cancel("refresh")
+    active_server = server
+    mpd_cache = server.cache
+    last_song_id = None
+    playing_header_valid = False
+    lyrics_requested = None
+    library_path = []
+    library_cursor = 0
+    library_scroll = 0
+    queue_cursor = -2
+    queue_moving_from = -1
+
+# 再生履歴（最近再生した曲を除いた一括追加用。MPDは再生履歴を持たないため本体側で記録）
+HISTORY_FILE = "/var/lib/mpd-client/history.txt"
+HISTORY_SIZE = 2000
+play_history = deque(maxlen=HISTORY_SIZE)
+
+def load_history():
+    """再生履歴を読み込む（長くなりすぎたファイルは切り詰める）"""
     try:
-        if mpd_connected:
-            mpd_client.close()
-            mpd_client.disconnect()
-            mpd_connected = False
-    except:
+        with open(HISTORY_FILE, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return
+    play_history.extend(lines[-HISTORY_SIZE:])
+    if len(lines) > HISTORY_SIZE * 2:
+        try:
+            with open(HISTORY_FILE, "w", encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in play_history))
+        except OSError:
+            pass
+
+def note_played(file):
+    """再生中の曲が変わったら履歴に追加"""
+    if not file or (play_history and play_history[-1] == file):
+        return
+    play_history.append(file)
+    if headless:
+        return  # 再生・テスト時はファイルに残さない
+    try:
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(file + "\n")
+    except OSError:
         pass
 
+# 一括追加（専用の接続でライブラリから曲を選び、コマンドリストでまとめて追加）
+ENQUEUE_CHUNK = 100  # 1回のコマンドリストで追加する曲数
+ENQUEUE_PAGE = 500  # ライブラリを検索するときの1回の取得数
+ENQUEUE_COUNTS = [50, 100, 500, 1000, 5000, 10000]
+ENQUEUE_RANDOM = 0
+ENQUEUE_NOT_RECENT = 1
+ENQUEUE_GENRE = 2
+ENQUEUE_ALL = 3
+ENQUEUE_MODE_NAMES = ["ランダム", "最近聴いていない曲", "ジャンル", "全曲"]
+
+class EnqueueJob:
+    """一括追加の設定と進捗（エンジンのスレッドが更新し、描画はここから読む）"""
+
+    def __init__(self, mode, count, genre, replace):
+        self.mode = mode
+        self.count = count
+        self.genre = genre
+        self.replace = replace
+        self.server = active_server
+        self.total = None  # 追加する曲数（選曲が終わるまでNone）
+        self.added = 0
+        self.skipped = 0  # 追加に失敗した曲
+        self.state = "running"  # running / done / cancelled / error
+        self.error = None
+        self.cancel = threading.Event()
+
+    def running(self):
+        return self.state == "running"
+
+enqueue_job = None
+
+def enqueue_filter(job):
+    """選曲対象の検索条件（MPDのフィルタ式）"""
+    if job.mode == ENQUEUE_GENRE:
+        value = job.genre.replace("\\", "\\\\").replace('"', '\\"')
+        return f'(genre == "{value}")'
+    return '(modified-since "0")'  # 更新日時が0以降 = ライブラリ全体
+
+def iter_library(client, expr, total, positions=None):
+    """検索結果をページ単位で取得し、positions（昇順）の位置の曲のファイルを順に返す（Noneはすべて）"""
+    index = 0
+    page_start = 0
+    while page_start < total:
+        if positions is not None:
+            if index >= len(positions):
+                return
+            # 抽出する位置を含まないページは取得しない
+            page_start = positions[index] // ENQUEUE_PAGE * ENQUEUE_PAGE
+        songs = client.find(expr, "window", f"{page_start}:{page_start + ENQUEUE_PAGE}")
+        if positions is None:
+            for song in songs:
+                yield song['file']
+        else:
+            while index < len(positions) and positions[index] < page_start + len(songs):
+                yield songs[positions[index] - page_start]['file']
+                index += 1
+        if len(songs) < ENQUEUE_PAGE:
+            return  # 末尾（取得中にライブラリが減った場合も含む）
+        page_start += ENQUEUE_PAGE
+
+def sample_positions(total, count, used):
+    """0〜total-1のうちusedにない位置をcount個選ぶ（昇順）"""
+    if len(used) * 2 > total:
+        return sorted(random.sample([p for p in range(total) if p not in used], count))
+    picks = set()
+    while len(picks) < count:
+        p = random.randrange(total)
+        if p not in used:
+            picks.add(p)
+    return sorted(picks)
+
+def iter_not_recent(client, expr, total, count):
+    """履歴にない曲をcount曲まで順に返す（履歴にあった分は、まだ選んでいない位置から選び直す）"""
+    recent = set(play_history)
+    used = set()
+    while count > 0 and len(used) < total:
+        positions = sample_positions(total, min(count, total - len(used)), used)
+        used.update(positions)
+        for file in iter_library(client, expr, total, positions):
+            if file not in recent:
+                count -= 1
+                yield file
+
+def enqueue_chunk(client, files, job):
+    """1回のコマンドリストでまとめて追加（失敗した曲は飛ばして残りを送り直す）"""
+    global data_ready
+    while files:
+        try:
+            client.command_list_ok_begin()
+            for file in files:
+                client.addid(file)
+            client.command_list_end()
+            job.added += len(files)
+            break
+        except CommandError as e:
+            # コマンドリストは失敗した位置（[50@3]の3）で中断される
+            m = re.search(r"@(\d+)\]", str(e))
+            failed = int(m.group(1)) if m else len(files) - 1
+            job.added += failed
+            job.skipped += 1
+            files = files[failed + 1:]
+    data_ready = True
+
+def enqueue_run(job):
+    """一括追加のスレッド（UIのワーカーとは別の接続を使う）"""
+    global data_ready
+    client = mpd_client_factory()
+    try:
+        client.connect(job.server.host, job.server.port, timeout=MPD_TIMEOUT)
+        expr = enqueue_filter(job)
+        total = int(client.count(expr)['songs'])
+        count = total if job.mode == ENQUEUE_ALL else min(job.count, total)
+
+        if job.mode == ENQUEUE_NOT_RECENT:
+            files = iter_not_recent(client, expr, total, count)
+        elif count < total:
+            files = iter_library(client, expr, total, sorted(random.sample(range(total), count)))
+        else:
+            files = iter_library(client, expr, total)
+        job.total = count
+        data_ready = True
+
+        if job.cancel.is_set():
+            job.state = "cancelled"  # 入れ替える前なら再生キューはそのまま
+            return
+        if job.replace:
+            client.clear()
+        base = int(client.status().get('playlistlength', 0))
+        shuffle = job.mode != ENQUEUE_ALL
+        started = not job.replace
+        chunk = []
+        for file in files:
+            chunk.append(file)
+            if len(chunk) >= ENQUEUE_CHUNK:
+                enqueue_chunk(client, chunk, job)
+                chunk = []
+                if not started and job.added:
+                    # 入れ替えのときは最初のまとまりを追加した時点で再生を始める（中止しても止まったままにしない）
+                    if shuffle and job.added > 1:
+                        client.shuffle(f"0:{job.added}")
+                    client.play(0)
+                    started = True
+                if job.cancel.is_set():
+                    break
+        if chunk and (not job.cancel.is_set() or not started):
+            enqueue_chunk(client, chunk, job)
+        if job.mode == ENQUEUE_NOT_RECENT and not job.cancel.is_set():
+            job.total = job.added + job.skipped  # 履歴を除くと足りなかった場合
+
+        # ライブラリ順に追加したので、追加した範囲のうち再生中の曲より後ろだけシャッフル
+        status = client.status()
+        start = base
+        if 'song' in status:
+            start = max(start, int(status['song']) + 1)
+        if shuffle and base + job.added - start > 1:
+            client.shuffle(f"{start}:{base + job.added}")
+        if not started and job.added:
+            client.play(0)
+        job.state = "cancelled" if job.cancel.is_set() else "done"
+    except Exception as e:
+        job.error = str(e)
+        job.state = "error"
+    finally:
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+        data_ready = True
+
+def start_enqueue(mode, count, genre, replace):
+    """一括追加を開始"""
+    global enqueue_job
+    enqueue_job = EnqueueJob(mode, count, genre, replace)
+    threading.Thread(target=enqueue_run, args=(enqueue_job,), name="enqueue", daemon=True).start()
+
 # フォント読み込み
 try:
     font = ImageFont.truetype("/usr/share/fonts/truetype/misaki/misaki_gothic.ttf", 8)
-    font_16 = ImageFont.truetype("/usr/share/fonts/truetype/misaki/misaki_gothic.ttf", 16)
 except:
-    font = ImageFont.load_default()
-    font_16 = ImageFont.load_default()
+    font = ImageFont.load_default()  # Pillow 10以降は10pxのフォント（1行は2ページになる）
+
+def font_row_height(font):
+    """フォントの1行の高さ（px）。ページ単位で描画・転送するため8の倍数に切り上げる"""
+    left, top, right, bottom = font.getbbox("Agjy|漢字あ")
+    return max(8, -(-bottom // 8) * 8)
+
+class BufferSpiDev:
+    """spidevのwritebytesをwritebytes2に差し替えるラッパー（lumaのspiに spi= で渡す）
+
+    lumaのdata()/command()はwritebytesで送るため、そのままではバッファがリストに変換される。
+    writebytes2はバッファをそのまま受け取れる（受け付けない実装ならwritebytesに戻す）。
+    """
+
+    def __init__(self, spidev):
+        object.__setattr__(self, "_spidev", spidev)
+        object.__setattr__(self, "buffer_ok", True)
+
+    def writebytes(self, data):
+        if self.buffer_ok:
+            try:
+                self._spidev.writebytes2(data)
+                return
+            except TypeError:
+                object.__setattr__(self, "buffer_ok", False)
+        self._spidev.writebytes(list(data))
+
+    def __getattr__(self, name):
+        return getattr(self._spidev, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._spidev, name, value)
+
+def buffer_spidev():
+    """writebytes2のあるspidev（3.4以降）ならラッパーを返す（なければNoneでlumaの既定を使う）"""
+    try:
+        import spidev
+    except ImportError:
+        return None
+    if not hasattr(spidev.SpiDev, "writebytes2"):
+        return None
+    return BufferSpiDev(spidev.SpiDev())
 
 # ディスプレイ初期化
-serial = spi(device=0, port=0, bus_speed_hz=8000000, transfer_size=4096, gpio_DC=DC_PIN, gpio_RST=RST_PIN)
-device = sh1106(serial, rotate=2)
+if headless:
+    # ヘッドレス: 描画結果をメモリ上に保持するだけのダミーデバイスとモックGPIO
+    from luma.core.device import dummy
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory
+    Device.pin_factory = MockFactory()
+    device = dummy(width=width, height=height, mode="RGB" if greyscale else "1")
+else:
+    serial = spi(spi=buffer_spidev(), device=0, port=0, bus_speed_hz=8000000, transfer_size=4096,
+                 gpio_DC=DC_PIN, gpio_RST=RST_PIN)
+    if greyscale:
+        # グレースケールパネルはlumaの差分転送に任せる（回転もluma側）
+        device = panel_class(serial, width=width, height=height, rotate=2, mode="RGB")
+    else:
+        device = panel_class(serial, width=width, height=height)
+        # 180度回転はコントローラ側で行う（セグメント・COMスキャン方向を反転）
+        device.command(0xA0, 0xC0)
+
+glyph_cache = {}  # (文字, フォント) -> (列データ, 送り幅)（列データは1列をフォントの行の高さのビットで表す）
+
+class PageCanvas:
+    """SH1106/SSD1306系のGDDRAMと同じページ形式（1列1バイト、下位ビットが上）のフレームバッファ
+
+    描画関数からはImageDrawと同じように text() / rectangle() で描画できる。
+    バッファは起動時に確保したものを使い回し、変換やコピーなしでパネルへ送る。
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.buffer = bytearray(width * self.pages)
+        self.view = memoryview(self.buffer)
+        self.zeros = memoryview(bytes(width * self.pages))
+        self.ones = memoryview(b"\xff" * (width * self.pages))
+        self.glyphs = glyph_cache
+
+    def clear(self, first_page=0, last_page=None):
+        """指定したページ範囲を消去"""
+        if last_page is None:
+            last_page = self.pages - 1
+        start = first_page * self.width
+        end = (last_page + 1) * self.width
+        self.view[start:end] = self.zeros[start:end]
+
+    def page(self, page, x=0, count=None):
+        """1ページ分（またはその一部）のバッファ"""
+        start = page * self.width + x
+        return self.view[start:start + (self.width - x if count is None else count)]
+
+    def blit_page(self, page, data):
+        """描画済みのページ形式の列データ（1ページ分またはその倍数）をpageから書き込む"""
+        start = page * self.width
+        self.view[start:start + len(data)] = data
+
+    def glyph(self, ch, font):
+        """文字の (列データ, 送り幅)（初回のみPILで描画してキャッシュ）"""
+        key = (ch, font)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            advance = int(round(font.getlength(ch)))
+            height = font_row_height(font)
+            image = Image.new("1", (advance + 8, height))  # 送り幅からはみ出す部分も含める
+            ImageDraw.Draw(image).text((0, 0), ch, font=font, fill=255)
+            pixels = image.load()
+            columns = [sum(1 << y for y in range(height) if pixels[x, y]) for x in range(image.width)]
+            while len(columns) > advance and not columns[-1]:
+                columns.pop()
+            glyph = self.glyphs[key] = (tuple(columns), advance)
+        return glyph
+
+    def text(self, xy, text, font=None, fill=255):
+        """1行のテキストを描画（yがページ境界にない場合は1ページ多くまたがる）"""
+        x, y = xy
+        first_page, shift = divmod(y, 8)
+        buf = self.buffer
+        w = self.width
+        pages = self.pages
+        for ch in text:
+            if x >= w:
+                break
+            columns, advance = self.glyph(ch, font)
+            col_x = x
+            for column in columns:
+                if column and 0 <= col_x < w:
+                    # 列のビットを下位から1ページ（8bit）ずつ書き込む
+                    bits = column << shift
+                    page = first_page
+                    while bits:
+                        if 0 <= page < pages:
+                            b = bits & 0xFF
+                            if fill:
+                                buf[page * w + col_x] |= b
+                            else:
+                                buf[page * w + col_x] &= ~b
+                        bits >>= 8
+                        page += 1
+                col_x += 1
+            x += advance
+
+    def _fill(self, x0, y0, x1, y1, fill):
+        """矩形範囲（両端を含む）を塗る"""
+        x0 = max(0, x0)
+        x1 = min(self.width - 1, x1)
+        y0 = max(0, y0)
+        y1 = min(self.height - 1, y1)
+        if x0 > x1 or y0 > y1:
+            return
+        buf = self.buffer
+        for page in range(y0 // 8, y1 // 8 + 1):
+            top = max(y0 - page * 8, 0)
+            bottom = min(y1 - page * 8, 7)
+            mask = (0xFF >> (7 - bottom)) & (0xFF << top) & 0xFF
+            start = page * self.width + x0
+            end = page * self.width + x1 + 1
+            if mask == 0xFF:
+                self.view[start:end] = (self.ones if fill else self.zeros)[start:end]
+            elif fill:
+                for i in range(start, end):
+                    buf[i] |= mask
+            else:
+                for i in range(start, end):
+                    buf[i] &= ~mask
+
+    def invert(self, xy):
+        """矩形範囲（両端を含む）の白黒を反転"""
+        x0, y0, x1, y1 = xy
+        x0 = max(0, x0)
+        x1 = min(self.width - 1, x1)
+        y0 = max(0, y0)
+        y1 = min(self.height - 1, y1)
+        if x0 > x1 or y0 > y1:
+            return
+        buf = self.buffer
+        for page in range(y0 // 8, y1 // 8 + 1):
+            top = max(y0 - page * 8, 0)
+            bottom = min(y1 - page * 8, 7)
+            mask = (0xFF >> (7 - bottom)) & (0xFF << top) & 0xFF
+            for i in range(page * self.width + x0, page * self.width + x1 + 1):
+                buf[i] ^= mask
+
+    def rectangle(self, xy, outline=None, fill=None):
+        """ImageDraw.rectangleと同じく、内部をfillで塗り、外周をoutlineで描画"""
+        x0, y0, x1, y1 = xy
+        if fill is not None:
+            self._fill(x0, y0, x1, y1, fill)
+        if outline is not None and outline != fill:
+            self._fill(x0, y0, x1, y0, outline)
+            self._fill(x0, y1, x1, y1, outline)
+            self._fill(x0, y0, x0, y1, outline)
+            self._fill(x1, y0, x1, y1, outline)
+
+    def to_image(self):
+        """PILイメージに変換（ヘッドレス時のダミーデバイス用）"""
+        image = Image.new("1", (self.width, self.height))
+        pixels = image.load()
+        for page in range(self.pages):
+            base = page * self.width
+            for x in range(self.width):
+                column = self.buffer[base + x]
+                for bit in range(8):
+                    if column >> bit & 1:
+                        pixels[x, page * 8 + bit] = 255
+        return image
+
+class GreyCanvas:
+    """4bitグレースケールパネル用のフレームバッファ（PILのLイメージに描画し、lumaで送る）
+
+    PageCanvasと同じ text() / rectangle() / clear() / blit_page() を持つ（blit_pageは明るさも指定できる）。
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.image = Image.new("L", (width, height))
+        self.pixels = self.image.load()
+        self.draw = ImageDraw.Draw(self.image)
+        self.draw.fontmode = "1"  # ドットフォントをにじませない
+        self.text = self.draw.text
+        self.rectangle = self.draw.rectangle
+
+    def clear(self, first_page=0, last_page=None):
+        """指定したページ範囲を消去"""
+        if last_page is None:
+            last_page = self.pages - 1
+        self.draw.rectangle((0, first_page * 8, self.width - 1, last_page * 8 + 7), fill=0)
+
+    def blit_page(self, page, data, fill=255):
+        """ページ形式の列データ（1ページ分またはその倍数）を指定の明るさで書き込む"""
+        pixels = self.pixels
+        for offset in range(0, len(data), self.width):
+            top = (page + offset // self.width) * 8
+            for x in range(self.width):
+                column = data[offset + x]
+                for bit in range(8):
+                    pixels[x, top + bit] = fill if column >> bit & 1 else 0
+
+    def to_image(self):
+        return self.image.convert("RGB")
+
+framebuffer = GreyCanvas(width, height) if greyscale else PageCanvas(width, height)
+native_panel = isinstance(device, (sh1106, ssd1306))
+# SSD1306系の表示開始列（luma.oledのssd1306と同じく、64px幅のパネルはRAMの中央に表示）
+panel_colstart = 32 if isinstance(device, ssd1306) and width == 64 else 0
+
+def flush_pages(first_page=0, last_page=None, x=0, count=None):
+    """フレームバッファの指定範囲をそのままパネルへ送る"""
+    if not native_panel:
+        device.display(framebuffer.to_image())
+        return
+    if last_page is None:
+        last_page = framebuffer.pages - 1
+    if count is None:
+        count = framebuffer.width - x
+    if isinstance(device, sh1106):
+        # ページアドレッシング: ページごとに開始列を指定
+        col = x + 2  # sh1106は132列のRAMの2列目から表示
+        for page in range(first_page, last_page + 1):
+            device.command(0xB0 | page, col & 0x0F, 0x10 | (col >> 4))
+            device.data(framebuffer.page(page, x, count))
+    else:
+        # SSD1306系は水平アドレッシング: 範囲を指定すれば続けて書き込める
+        col = x + panel_colstart
+        device.command(0x21, col, col + count - 1, 0x22, first_page, last_page)
+        if count == framebuffer.width:
+            device.data(framebuffer.view[first_page * count:(last_page + 1) * count])
+        else:
+            for page in range(first_page, last_page + 1):
+                device.data(framebuffer.page(page, x, count))
+
+class Layout:
+    """画面サイズとフォントから求めた行・列の位置（起動時に1回だけ計算）"""
+
+    def __init__(self, width, height, font, greyscale):
+        self.width = width
+        self.height = height
+        self.right = width - 1
+        self.row = font_row_height(font)  # 1行の高さ（ページの倍数。8pxフォントなら1ページ）
+        self.row_pages = self.row // 8
+        self.rows = height // self.row
+
+        # リスト画面: 1行目はヘッダー、最終行は空ける
+        self.list_top = self.row
+        self.list_lines = self.rows - 2
+        self.list_bottom = self.list_top + self.list_lines * self.row  # スクロールバーの下端
+        # 再生キュー: ヘッダー2行（リピート、シャッフル）
+        self.queue_top = self.row * 2
+        self.queue_lines = self.rows - 3
+        # 右端3pxはスクロールバー、カーソルの反転表示はその手前まで
+        self.scrollbar_x = width - 3
+        self.cursor_right = width - 4
+
+        # 再生中画面: 下部3行に進捗・ボリューム・時刻、スペクトラムと歌詞は最下部の2行
+        self.footer_y = height - self.row * 3
+        self.footer_page = self.footer_y // 8
+        self.bottom_page = (height - self.row * 2) // 8
+        time_width = int(round(font.getlength("00:00")))
+        self.duration_x = width - time_width
+        self.clock_x = width - time_width - 4
+        self.volume_x = width // 2 - time_width
+
+        self.busy_x = width - self.row  # 右上のビジー表示
+        # プロファイル採取中の表示はステータス欄（再生中画面は下部3行の1行目の中央、他の画面は空けてある最終行の右端）
+        self.profile_width = int(round(font.getlength(PROFILE_BADGE))) + 2
+        self.profile_playing = ((width - self.profile_width) // 2, self.footer_y)
+        self.profile_status = (width - self.profile_width, height - self.row)
+        self.overlay_width = 80
+        self.overlay_x = (width - self.overlay_width) // 2
+        # 補助的な情報の明るさ（グレースケールパネルのみ暗くする）
+        self.dim = 0x60 if greyscale else 255
+
+layout = Layout(width, height, font, greyscale)
 
 # グローバル変数
+clock = time.time  # 入力処理の時計（再生時は記録時刻に差し替え）
 state = STATE_OFF
-start = time.time()
+start = clock()
 last_press_time = {}
 DEBOUNCE_TIME = 0.2
 need_redraw = True  # 画面再描画フラグ
+last_frame_fingerprint = None  # 前回描画した画面の依存データ
 
 # 再生中画面用変数
 last_song_id = None  # 前回の曲ID
-last_playing_image = None  # 前回の再生中画面イメージ
+playing_header_valid = False  # フレームバッファ上部（曲情報）が現在の曲のものか
+
+# 再生中画面の下部の表示
+VIEW_NORMAL = 0  # 進捗バー、ボリューム、時刻
+VIEW_VISUALIZER = 1  # スペクトラム
+VIEW_LYRICS = 2  # 歌詞
+VIEW_NAMES = ["通常", "スペクトラム", "歌詞"]
+playing_view = VIEW_NORMAL
+
+# ビジュアライザ（MPDのfifo出力を解析して再生中画面の下部にスペクトラムを表示）
+VISUALIZER_FIFO = "/tmp/mpd.fifo"  # mpd.confのfifo出力のpath（format "44100:16:2"）
+VISUALIZER_FPS = 25
+VISUALIZER_BLOCK = 1024  # FFTのサンプル数（44.1kHzで約23ms）
+VISUALIZER_BANDS = width // 4  # 1バンド4px（バー3px + 隙間1px）
+VISUALIZER_PAGE = layout.bottom_page  # バーを描くページ（最下部の2行）
+VISUALIZER_HEIGHT = layout.row * 2
+
+class SpectrumVisualizer:
+    """MPDのfifo出力からバンドごとの強さを計算（バッファはすべて事前に確保して再利用）"""
+
+    FLOOR = 3.0  # 表示する強さの範囲（FFT振幅の常用対数）
+    CEIL = 7.0
+    DECAY = 1.0  # 1フレームでバーが下がる量（px）
+
+    def __init__(self, path, block, bands, max_height):
+        self.path = path
+        self.max_height = max_height
+        self.running = False
+        self.resume = threading.Event()
+        self.thread = None
+
+        # 読み込み用と最新ブロック用（16bitステレオ）
+        self.raw = bytearray(block * 4)
+        self.raw_view = memoryview(self.raw)
+        self.latest = bytearray(block * 4)
+        self.latest_seq = 0
+        self.used_seq = 0
+        self.lock = threading.Lock()
+
+        # FFT用
+        self.pcm = np.zeros(block * 2, dtype=np.int16)
+        self.stereo = self.pcm.reshape(-1, 2)
+        self.mono = np.zeros(block)
+        self.window = np.hanning(block)
+        self.spectrum = np.zeros(block // 2 + 1, dtype=complex)
+        self.magnitude = np.zeros(block // 2 + 1)
+        self.cumsum = np.zeros(block // 2 + 1)
+        try:
+            np.fft.rfft(self.mono, out=self.spectrum)
+            self.fft_out = True
+        except TypeError:
+            self.fft_out = False  # NumPy 2.0未満は出力先を指定できない
+
+        # 対数間隔のバンド（FFTのビン範囲）
+        edges = np.geomspace(2, block // 2, bands + 1).astype(int)
+        for i in range(1, bands + 1):
+            edges[i] = max(edges[i], edges[i - 1] + 1)  # 低域でも1ビン以上
+        self.lo = edges[:-1].copy()
+        self.hi = edges[1:].copy()
+        self.width = (self.hi - self.lo).astype(float)
+        self.band_lo = np.zeros(bands)
+        self.band_hi = np.zeros(bands)
+        self.levels = np.zeros(bands)
+        self.fall = np.zeros(bands)
+        self.smoothed = np.zeros(bands)
+        self.heights = np.zeros(bands, dtype=int)
+
+    def start(self):
+        self.running = True
+        self.resume.set()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._read_loop, name="visualizer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _read_loop(self):
+        """表示中はfifoを読み続け、最新の1ブロックだけを残す（処理が遅れても溜めない）"""
+        fd = None
+        filled = 0
+        try:
+            while True:
+                if not self.running:
+                    # 表示していない間はfifoを閉じて再開を待つ
+                    if fd is not None:
+                        os.close(fd)
+                        fd = None
+                    self.resume.wait()
+                    self.resume.clear()
+                    continue
+                if fd is None:
+                    try:
+                        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+                    except OSError:
+                        self.running = False
+                        continue
+                    filled = 0
+                ready, _, _ = select.select([fd], [], [], 0.5)
+                if not ready:
+                    continue
+                try:
+                    n = os.readv(fd, [self.raw_view[filled:]])
+                except BlockingIOError:
+                    continue
+                if n == 0:
+                    # MPD側が閉じている（停止中）
+                    time.sleep(0.2)
+                    continue
+                filled += n
+                if filled == len(self.raw):
+                    with self.lock:
+                        self.latest[:] = self.raw
+                        self.latest_seq += 1
+                    filled = 0
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def update(self):
+        """最新ブロックからバーの高さを計算（新しいブロックがなければ減衰のみ）"""
+        with self.lock:
+            fresh = self.latest_seq != self.used_seq
+            if fresh:
+                self.pcm.view(np.uint8)[:] = self.latest
+                self.used_seq = self.latest_seq
+
+        if fresh:
+            np.add(self.stereo[:, 0], self.stereo[:, 1], out=self.mono, dtype=float)
+            np.multiply(self.mono, self.window, out=self.mono)
+            if self.fft_out:
+                np.fft.rfft(self.mono, out=self.spectrum)
+                np.abs(self.spectrum, out=self.magnitude)
+            else:
+                np.abs(np.fft.rfft(self.mono), out=self.magnitude)
+            np.cumsum(self.magnitude, out=self.cumsum)
+            np.take(self.cumsum, self.hi, out=self.band_hi)
+            np.take(self.cumsum, self.lo, out=self.band_lo)
+            np.subtract(self.band_hi, self.band_lo, out=self.levels)
+            np.divide(self.levels, self.width, out=self.levels)
+            np.add(self.levels, 1.0, out=self.levels)
+            np.log10(self.levels, out=self.levels)
+            np.subtract(self.levels, self.FLOOR, out=self.levels)
+            np.multiply(self.levels, self.max_height / (self.CEIL - self.FLOOR), out=self.levels)
+            np.clip(self.levels, 0, self.max_height, out=self.levels)
+        else:
+            self.levels.fill(0)
+
+        # 上がるときは即座に、下がるときはゆっくり
+        np.subtract(self.smoothed, self.DECAY, out=self.fall)
+        np.maximum(self.levels, self.fall, out=self.smoothed)
+        np.copyto(self.heights, self.smoothed, casting='unsafe')
+        return self.heights
+
+visualizer = SpectrumVisualizer(VISUALIZER_FIFO, VISUALIZER_BLOCK, VISUALIZER_BANDS, VISUALIZER_HEIGHT) if np is not None else None
+visualizer_shown = [0] * VISUALIZER_BANDS  # パネルに表示中のバーの高さ
+
+VISUALIZER_BOTTOM = VISUALIZER_PAGE * 8 + VISUALIZER_HEIGHT - 1
+
+def draw_bar(draw, band, h):
+    """1バンド分のバーを描画"""
+    x = band * 4
+    draw.rectangle((x, VISUALIZER_BOTTOM - VISUALIZER_HEIGHT + 1, x + 2, VISUALIZER_BOTTOM), fill=0)
+    if h > 0:
+        draw.rectangle((x, VISUALIZER_BOTTOM - h + 1, x + 2, VISUALIZER_BOTTOM), fill=255)
+
+def draw_visualizer_bars(draw):
+    """ビジュアライザのバーを描画（全体描画時）"""
+    heights = visualizer.heights
+    for band in range(VISUALIZER_BANDS):
+        h = int(heights[band])
+        visualizer_shown[band] = h
+        draw_bar(draw, band, h)
+
+def visualizer_frame():
+    """バーの高さを更新し、変化した列だけをパネルへ送る"""
+    heights = visualizer.update()
+    if not native_panel:
+        # 画像に変換して全面を送るパネルでは、全バーを描いてから1回だけ送る
+        changed = False
+        for band in range(VISUALIZER_BANDS):
+            h = int(heights[band])
+            if h != visualizer_shown[band]:
+                visualizer_shown[band] = h
+                draw_bar(framebuffer, band, h)
+                changed = True
+        if changed:
+            flush_pages()
+        return
+    band = 0
+    while band < VISUALIZER_BANDS:
+        if heights[band] == visualizer_shown[band]:
+            band += 1
+            continue
+        # 変化したバンドが連続する範囲をフレームバッファに描いてまとめて送る
+        first = band
+        while band < VISUALIZER_BANDS and heights[band] != visualizer_shown[band]:
+            h = int(heights[band])
+            visualizer_shown[band] = h
+            draw_bar(framebuffer, band, h)
+            band += 1
+        flush_pages(VISUALIZER_PAGE, VISUALIZER_PAGE + VISUALIZER_HEIGHT // 8 - 1, first * 4, (band - first) * 4)
+
+def visualizer_active():
+    """スペクトラムが見えていて再生中か（画面オフ・一時停止・停止中はfifoの読み込みもFFTも行わない）"""
+    return playing_view == VIEW_VISUALIZER and state == STATE_PLAYING and effective_status().get('state') == 'play'
+
+def sync_visualizer(active):
+    """表示状態が変わったときにfifoの読み込みを開始・停止"""
+    if visualizer is not None:
+        if active:
+            visualizer.start()
+        else:
+            visualizer.stop()
+
+# 歌詞（.lrcを読み込み、行ごとの時刻と描画済みの列データを保持）
+LYRICS_PAGE = layout.bottom_page  # 現在の行（次の行はその1行下のページ）
+LRC_TIME_TAG = re.compile(r"\[(\d+):(\d+(?:\.\d+)?)\]")
+LRC_OFFSET_TAG = re.compile(r"\[offset:\s*([+-]?\d+)\]", re.IGNORECASE)
+lyrics = (None, [], [], [])  # (ファイル, 開始時刻の配列, 行の配列, 行ごとのページ列データ)
+LYRICS_RETRY_BASE = 2.0  # 読み込みに失敗した歌詞を要求し直すまでの間隔（秒、失敗のたびに倍）
+LYRICS_RETRY_MAX = 60.0
+lyrics_requested = None  # 読み込みを要求したファイル
+lyrics_failures = 0  # lyrics_requested の読み込みに続けて失敗した回数
+lyrics_retry_time = 0.0  # 失敗した読み込みをこの時刻以降に要求し直す
+lyrics_shown = None  # パネルに表示中の行番号
+
+def parse_lrc(text):
+    """LRC形式の歌詞を時刻順の (開始時刻の配列, 行の配列) に変換"""
+    offset = 0.0
+    entries = []
+    for line in text.splitlines():
+        m = LRC_OFFSET_TAG.match(line.strip())
+        if m:
+            # 正の値は歌詞を早める（ミリ秒）
+            offset = int(m.group(1)) / 1000.0
+            continue
+        tags = LRC_TIME_TAG.findall(line)
+        body = LRC_TIME_TAG.sub("", line).strip()
+        for minutes, seconds in tags:
+            entries.append((int(minutes) * 60 + float(seconds), body))
+    entries.sort(key=lambda entry: entry[0])
+    return [t - offset for t, _ in entries], [body for _, body in entries]
+
+def render_page(text):
+    """1行分のテキストをページ形式の列データ（1列1バイト、下位ビットが上。行の高さ分のページ）に変換"""
+    line = PageCanvas(width, layout.row)
+    line.text((0, 0), text, font=font, fill=255)
+    return bytes(line.buffer)
+
+def read_lyrics_text(client, file, directory):
+    """曲の歌詞を取得（同じ場所の.lrc → タグ → ステッカーの順。directoryがNoneなら.lrcは読まない）"""
+    if directory is not None:
+        path = os.path.join(directory, os.path.splitext(file)[0] + ".lrc")
+        try:
+            with open(path, encoding="utf-8-sig", errors="replace") as f:
+                return f.read()
+        except OSError:
+            pass
+    try:
+        comments = client.readcomments(file)
+        for key in ('lyrics', 'unsyncedlyrics'):
+            text = comments.get(key)
+            if isinstance(text, list):
+                text = "\n".join(text)
+            if text and LRC_TIME_TAG.search(text):
+                return text
+    except CommandError:
+        pass
+    try:
+        return client.sticker_get("song", file, "lyrics")
+    except CommandError:
+        return None
+
+def request_lyrics(file):
+    """歌詞の読み込みをワーカーに要求（曲ごとに1回。失敗した場合は retry_lyrics が要求し直す）"""
+    global lyrics_requested, lyrics_failures
+    if file == lyrics_requested:
+        return
+    lyrics_requested = file
+    lyrics_failures = 0
+    submit_lyrics(file)
+
+def submit_lyrics(file):
+    """歌詞を読み込むジョブを投入（失敗・破棄された場合は次に要求し直す時刻を延ばす）"""
+    def load(client):
+        global lyrics
+        text = read_lyrics_text(client, file, running_job().server.music_directory) if file else None
+        times, lines = parse_lrc(text) if text else ([], [])
+        lyrics = (file, times, lines, [render_page(line) for line in lines])
+
+    def failed():
+        # 接続エラー・期限切れ等で読めなかった: 間隔を空けて要求し直す
+        global lyrics_failures, lyrics_retry_time
+        if lyrics_requested == file:
+            lyrics_failures += 1
+            lyrics_retry_time = time.time() + min(LYRICS_RETRY_MAX, LYRICS_RETRY_BASE * 2 ** (lyrics_failures - 1))
+
+    def loaded(result, error):
+        global lyrics_failures
+        if error is not None:
+            failed()
+        elif lyrics_requested == file:
+            lyrics_failures = 0
+    mpd_submit(load, key="lyrics", deadline=MPD_TIMEOUT, on_done=loaded, on_drop=failed)
+
+def retry_lyrics():
+    """読み込みに失敗した歌詞を要求し直す（再生中画面の定期更新から呼ぶ。描画の有無に関係なく再試行する）"""
+    global lyrics_retry_time
+    if lyrics_failures and lyrics_active() and time.time() >= lyrics_retry_time:
+        lyrics_retry_time = float("inf")  # 結果が出るまで（失敗時は次の間隔を設定）
+        submit_lyrics(lyrics_requested)
+
+def interpolated_elapsed():
+    """最後に取得したstatusから現在の経過時間を推定"""
+    status = effective_status()
+    elapsed = float(status.get('elapsed', 0))
+    if status.get('state') == 'play':
+        elapsed += time.time() - mpd_cache["status_time"]
+    return elapsed
+
+def current_lyrics_index():
+    """経過時間に対応する歌詞の行番号（二分探索、歌詞がない場合はNone）"""
+    file, times, lines, pages = lyrics
+    if not times or file != mpd_cache["current"].get('file'):
+        return None
+    return bisect.bisect_right(times, interpolated_elapsed()) - 1
+
+def draw_lyrics(draw):
+    """歌詞を描画（全体描画時）"""
+    global lyrics_shown
+    request_lyrics(mpd_cache["current"].get('file'))
+    index = current_lyrics_index()
+    lyrics_shown = index
+    if index is None:
+        draw.text((0, LYRICS_PAGE * 8), "（歌詞なし）", font=font, fill=255)
+        return
+    lines = lyrics[2]
+    if index >= 0:
+        draw.text((0, LYRICS_PAGE * 8), lines[index], font=font, fill=255)
+    if index + 1 < len(lines):
+        draw.text((0, LYRICS_PAGE * 8 + layout.row), lines[index + 1], font=font, fill=layout.dim)
+
+EMPTY_PAGE = bytes(width * layout.row_pages)  # 空の1行
+
+def lyrics_frame():
+    """行が変わったときだけ、描画済みの列データをフレームバッファに書いて下部のページを送る"""
+    global lyrics_shown
+    index = current_lyrics_index()
+    if index is None or index == lyrics_shown:
+        return
+    lyrics_shown = index
+    pages = lyrics[3]
+    framebuffer.blit_page(LYRICS_PAGE, pages[index] if index >= 0 else EMPTY_PAGE)
+    next_page = pages[index + 1] if index + 1 < len(pages) else EMPTY_PAGE
+    if greyscale:
+        framebuffer.blit_page(LYRICS_PAGE + layout.row_pages, next_page, fill=layout.dim)
+    else:
+        framebuffer.blit_page(LYRICS_PAGE + layout.row_pages, next_page)
+    flush_pages(LYRICS_PAGE, LYRICS_PAGE + layout.row_pages * 2 - 1)
+
+def lyrics_active():
+    return playing_view == VIEW_LYRICS and state == STATE_PLAYING
+
+def cycle_playing_view():
+    """再生中画面の下部の表示を切り替え（通常 → スペクトラム → 歌詞）"""
+    global playing_view
+    playing_view = (playing_view + 1) % len(VIEW_NAMES)
+    if playing_view == VIEW_VISUALIZER and visualizer is None:
+        playing_view = VIEW_LYRICS  # NumPyがない場合は飛ばす
 
 # メニュー用変数
 menu_cursor = 0
@@ -128,9 +1848,29 @@ queue_scroll = 0
 queue_menu_cursor = 0
 queue_moving_from = -1  # 移動元のキュー位置（-1は移動モードでない）
 
+# プレイリスト閲覧用変数（表示範囲付近の曲だけを保持）
+playlist_name = None
+playlist_cursor = 0
+playlist_scroll = 0
+playlist_menu_cursor = 0
+PLAYLIST_MENU_ITEMS = ["ここから再生", "ここから追加", "この曲を追加", "全体を再生"]
+QUEUE_MENU_ITEMS = ["移動", "今すぐ再生", "削除"]
+SYSTEM_MENU_ITEMS = ["シャットダウン", "再起動"]
+
+# 一括追加の設定画面用変数
+enqueue_cursor = 0
+enqueue_mode = ENQUEUE_RANDOM
+enqueue_count_index = 1
+enqueue_genre_index = 0
+ENQUEUE_START_ROW = 3  # これ以降の行は開始（キューに追加、置き換えて再生）
+
+# サーバー選択画面用変数
+server_cursor = 0
+server_scroll = 0
+
 def debounce(pin):
     """デバウンス処理"""
-    current_time = time.time()
+    current_time = clock()
     if pin in last_press_time:
         if current_time - last_press_time[pin] < DEBOUNCE_TIME:
             return False
@@ -160,12 +1900,18 @@ def calc_text_width(text):
 
 def draw_playing_screen(draw):
     """再生中画面を描画"""
-    global last_song_id, last_playing_image, mpd_connected
+    global last_song_id, playing_header_valid
 
     try:
-        connect_mpd()
-        status = mpd_client.status()
-        current = mpd_client.currentsong()
+        if mpd_cache["error"]:
+            raise Exception(mpd_cache["error"])
+        status = effective_status()
+        current = mpd_cache["current"]
+        if not status:
+            draw.clear()
+            playing_header_valid = False
+            draw.text((0, 0), "接続中…", font=font, fill=255)
+            return
 
         # 曲情報取得
         current_song_id = current.get('id', None)
@@ -175,8 +1921,10 @@ def draw_playing_screen(draw):
         song_changed = (current_song_id != last_song_id)
 
         # 曲が変わった場合、または再生中でない場合は全体を描画
-        if song_changed or not is_playing or last_playing_image is None:
+        if song_changed or not is_playing or not playing_header_valid:
             last_song_id = current_song_id
+            draw.clear()
+            playing_header_valid = True
 
             # 曲情報取得
             title = current.get('title', 'Unknown')
@@ -184,27 +1932,25 @@ def draw_playing_screen(draw):
             album = current.get('album', 'Unknown Album')
             track = current.get('track', '')
 
-            # タイトル行（8pxフォント、スクロールなし）
+            # タイトル行（スクロールなし）
             y_pos = 0
             draw.text((0, y_pos), title, font=font, fill=255)
 
-            # アルバム名 - トラック番号（8px空けて16pxから開始）
-            y_pos = 16
+            # アルバム名 - トラック番号（1行空けて3行目）、アーティスト名（4行目）
+            # 行が高いフォントで下部3行に入り込む行は省く
             album_track = album
             if track:
                 album_track += f" - {track}"
-            draw.text((0, y_pos), album_track, font=font, fill=255)
-
-            # アーティスト名（更に8px下にシフト）
-            y_pos = 24
-            draw.text((0, y_pos), artist, font=font, fill=255)
+            for line, text in ((2, album_track), (3, artist)):
+                y_pos = line * layout.row
+                if y_pos + layout.row <= layout.footer_y:
+                    draw.text((0, y_pos), text, font=font, fill=layout.dim)
         else:
-            # 曲が同じ場合、上部40pxは前回のイメージから復元
-            if last_playing_image:
-                draw._image.paste(last_playing_image.crop((0, 0, 128, 40)), (0, 0))
+            # 曲が同じ場合、上部（下部3行より上のページ）はフレームバッファに残っているものをそのまま使う
+            draw.clear(layout.footer_page)
 
-        # 16px空ける
-        y_pos = 40
+        # 下部3行
+        y_pos = layout.footer_y
 
         # 再生進捗とトラックの長さ
         elapsed = float(status.get('elapsed', 0))
@@ -215,17 +1961,29 @@ def draw_playing_screen(draw):
 
         # 左端に再生進捗
         draw.text((0, y_pos), elapsed_str, font=font, fill=255)
-        # 右端にトラックの長さ（108pxから開始、5文字 = 40px）
-        draw.text((108, y_pos), duration_str, font=font, fill=255)
+        # 右端にトラックの長さ
+        draw.text((layout.duration_x, y_pos), duration_str, font=font, fill=255)
+
+        if playing_view != VIEW_NORMAL:
+            # スペクトラム・歌詞表示: 中央にボリューム、進捗は1pxの線、下部16pxに表示
+            draw.text((layout.volume_x, y_pos), f"Vol:{status.get('volume', '0')}%", font=font, fill=255)
+            if duration > 0:
+                progress = int((elapsed / duration) * layout.width)
+                draw.rectangle((0, y_pos + layout.row - 1, progress, y_pos + layout.row - 1), outline=255, fill=255)
+            if playing_view == VIEW_VISUALIZER:
+                draw_visualizer_bars(draw)
+            else:
+                draw_lyrics(draw)
+            return
 
         # すぐ下に進捗バー
-        y_pos += 8
-        bar_width = 128
+        y_pos += layout.row
+        bar_width = layout.width
         bar_height = 3
 
         if duration > 0:
             progress = int((elapsed / duration) * bar_width)
-            draw.rectangle((0, y_pos, bar_width - 1, y_pos + bar_height - 1), outline=255, fill=0)
+            draw.rectangle((0, y_pos, bar_width - 1, y_pos + bar_height - 1), outline=layout.dim, fill=0)
             draw.rectangle((0, y_pos, progress, y_pos + bar_height - 1), outline=255, fill=255)
 
         # ボリュームとローカルタイム
@@ -239,29 +1997,25 @@ def draw_playing_screen(draw):
 
         # 左にボリューム
         draw.text((0, y_pos), vol_text, font=font, fill=255)
-        # 右に時刻（右寄せ：128 - 24 = 104pxから開始、HH:MMは5文字=20px）
-        draw.text((104, y_pos), local_time, font=font, fill=255)
-
-        # 現在の画面イメージを保存（次回の部分更新用）
-        last_playing_image = draw._image.copy()
+        # 右に時刻（右端から4px空ける）
+        draw.text((layout.clock_x, y_pos), local_time, font=font, fill=255)
 
     except Exception as e:
-        mpd_connected = False  # 接続リセット（次回再接続）
+        draw.clear()
         draw.text((0, 0), "MPD接続エラー", font=font, fill=255)
-        draw.text((0, 8), str(e), font=font, fill=255)
+        draw.text((0, layout.row), str(e), font=font, fill=255)
         last_song_id = None
-        last_playing_image = None
+        playing_header_valid = False
 
 def draw_queue_screen(draw):
     """再生キュー画面を描画"""
-    global queue_items, queue_cursor, queue_scroll, queue_moving_from, mpd_connected
+    global queue_items, queue_cursor, queue_scroll, queue_moving_from
 
     try:
-        connect_mpd()
-        status = mpd_client.status()
-        playlist = mpd_client.playlistinfo()
-
-        queue_items = playlist
+        if mpd_cache["error"]:
+            raise Exception(mpd_cache["error"])
+        status = effective_status()
+        queue_items = mpd_cache["playlist"]
 
         # ヘッダー行1: リピート設定
         y_pos = 0
@@ -275,26 +2029,26 @@ def draw_queue_screen(draw):
 
         # カーソルが-2の場合（リピート行）
         if queue_cursor == -2:
-            draw.rectangle((0, y_pos, 127, y_pos + 7), outline=255, fill=255)
+            draw.rectangle((0, y_pos, layout.right, y_pos + layout.row - 1), outline=255, fill=255)
             draw.text((0, y_pos), repeat_text, font=font, fill=0)
         else:
             draw.text((0, y_pos), repeat_text, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
 
         # ヘッダー行2: シャッフル設定
         shuffle_text = "シャッフル[ON]" if status.get('random', '0') == '1' else "シャッフル[OFF]"
 
         # カーソルが-1の場合（シャッフル行）
         if queue_cursor == -1:
-            draw.rectangle((0, y_pos, 127, y_pos + 7), outline=255, fill=255)
+            draw.rectangle((0, y_pos, layout.right, y_pos + layout.row - 1), outline=255, fill=255)
             draw.text((0, y_pos), shuffle_text, font=font, fill=0)
         else:
             draw.text((0, y_pos), shuffle_text, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
 
         # キュー表示
         current_song_id = status.get('songid', '')
-        visible_lines = 5  # ヘッダー2行分減らす
+        visible_lines = layout.queue_lines  # ヘッダー2行分減らす
 
         if len(queue_items) > 0:
             # スクロール調整（カーソルが0以上の場合のみ）
@@ -323,59 +2077,132 @@ def draw_queue_screen(draw):
 
                 # カーソル位置は反転表示
                 if idx == queue_cursor:
-                    draw.rectangle((0, y_pos, 124, y_pos + 7), outline=255, fill=255)
+                    draw.rectangle((0, y_pos, layout.cursor_right, y_pos + layout.row - 1), outline=255, fill=255)
                     draw.text((0, y_pos), line_text, font=font, fill=0)
                 else:
                     draw.text((0, y_pos), line_text, font=font, fill=255)
 
-                y_pos += 8
+                y_pos += layout.row
 
             # スクロールバー
             if len(queue_items) > visible_lines:
-                bar_height = 40  # ヘッダー2行分減らす
+                bar_height = layout.list_bottom - layout.queue_top  # ヘッダー2行分減らす
                 thumb_height = max(3, int((visible_lines / len(queue_items)) * bar_height))
                 thumb_pos = int((queue_scroll / (len(queue_items) - visible_lines)) * (bar_height - thumb_height))
 
-                draw.rectangle((125, 16, 127, 56), outline=255, fill=0)
-                draw.rectangle((125, 16 + thumb_pos, 127, 16 + thumb_pos + thumb_height), outline=255, fill=255)
+                top = layout.queue_top + thumb_pos
+                draw.rectangle((layout.scrollbar_x, layout.queue_top, layout.right, layout.list_bottom), outline=layout.dim, fill=0)
+                draw.rectangle((layout.scrollbar_x, top, layout.right, top + thumb_height), outline=255, fill=255)
         else:
             draw.text((0, y_pos), "キューは空です", font=font, fill=255)
 
     except Exception as e:
-        mpd_connected = False  # 接続リセット（次回再接続）
         draw.text((0, 0), "MPD接続エラー", font=font, fill=255)
 
-def draw_main_menu(draw):
-    """メインメニューを描画"""
-    global menu_cursor, menu_items
+def main_menu_items():
+    """メインメニューの項目"""
+    enqueue = "一括追加"
+    if enqueue_job is not None and enqueue_job.running():
+        enqueue += f"[{enqueue_job.added}/{'?' if enqueue_job.total is None else enqueue_job.total}]"
+    items = ["再生中", "再生キュー", "ライブラリ", "システム", f"表示[{VIEW_NAMES[playing_view]}]", enqueue]
+    if len(mpd_servers) > 1:
+        items.append(f"サーバー[{active_server.name}]")
+    return items
+
+def server_state_text(server):
+    """サーバー選択画面に表示する状態（idleで取得済みのキャッシュから）"""
+    if server.failures:
+        return "接続不可"
+    if not server.watching and not server.cache["status"]:
+        return "…"
+    return {"play": "再生", "pause": "一時停止"}.get(server.cache["status"].get('state'), "停止")
+
+def draw_server_select(draw):
+    """サーバー選択画面を描画"""
+    global server_scroll
+    draw.text((0, 0), "[サーバー]", font=font, fill=255)
+    visible_lines = layout.list_lines
+    if server_cursor < server_scroll:
+        server_scroll = server_cursor
+    if server_cursor >= server_scroll + visible_lines:
+        server_scroll = server_cursor - visible_lines + 1
+    scrollbar = len(mpd_servers) > visible_lines
+    right = layout.cursor_right if scrollbar else layout.right
+
+    y_pos = layout.list_top
+    for i, server in enumerate(mpd_servers[server_scroll:server_scroll + visible_lines], server_scroll):
+        prefix = "> " if server is active_server else "  "
+        state_text = server_state_text(server)
+        fill = 255
+        if i == server_cursor:
+            draw.rectangle((0, y_pos, right, y_pos + layout.row - 1), outline=255, fill=255)
+            fill = 0
+        draw.text((0, y_pos), prefix + server.name, font=font, fill=fill)
+        draw.text((right + 1 - int(round(font.getlength(state_text))), y_pos), state_text, font=font, fill=fill)
+        y_pos += layout.row
+
+    # スクロールバー
+    if scrollbar:
+        bar_height = layout.list_bottom - layout.list_top
+        thumb_height = max(3, int((visible_lines / len(mpd_servers)) * bar_height))
+        thumb_pos = int((server_scroll / (len(mpd_servers) - visible_lines)) * (bar_height - thumb_height))
+
+        top = layout.list_top + thumb_pos
+        draw.rectangle((layout.scrollbar_x, layout.list_top, layout.right, layout.list_bottom), outline=layout.dim, fill=0)
+        draw.rectangle((layout.scrollbar_x, top, layout.right, top + thumb_height), outline=255, fill=255)
+
+def server_select_deps():
+    return (server_cursor, active_server.name,
+            tuple((server.failures > 0, server.watching, server.cache["status"].get('state')) for server in mpd_servers))
+
+def list_row_rect(i):
+    """全画面のメニューのi行目のカーソル範囲"""
+    y_pos = layout.list_top + i * layout.row
+    return (0, y_pos, layout.right, y_pos + layout.row - 1)
+
+def overlay_row_rect(count, i):
+    """オーバーレイメニュー（count項目）のi行目のカーソル範囲"""
+    menu_y = (layout.height - (count + 1) * layout.row) // 2
+    y_pos = menu_y + 4 + i * layout.row
+    return (layout.overlay_x + 4, y_pos, layout.overlay_x + layout.overlay_width - 4, y_pos + layout.row - 1)
+
+def draw_main_menu(draw, cursor):
+    """メインメニューを描画（cursorがNoneならカーソルなし）"""
+    global menu_items
     
-    menu_items = ["再生中", "再生キュー", "ライブラリ", "システム"]
+    menu_items = main_menu_items()
     
-    y_pos = 8
+    y_pos = layout.list_top
     for i, item in enumerate(menu_items):
-        if i == menu_cursor:
-            draw.rectangle((0, y_pos, 127, y_pos + 7), outline=255, fill=255)
+        if i == cursor:
+            draw.rectangle(list_row_rect(i), outline=255, fill=255)
             draw.text((0, y_pos), item, font=font, fill=0)
         else:
             draw.text((0, y_pos), item, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
 
 def draw_library_screen(draw):
     """ライブラリ画面を描画"""
-    global library_items, library_cursor, library_scroll, mpd_connected
+    global library_items, library_cursor, library_scroll
 
     try:
-        connect_mpd()
+        if mpd_cache["error"]:
+            raise Exception(mpd_cache["error"])
 
         # パス表示
         y_pos = 0
         path_text = "[ライブラリ]/" + "/".join(library_path) if library_path else "[ライブラリ]/"
         draw.text((0, y_pos), path_text, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
 
         # アイテム取得
         current_path = "/".join(library_path) if library_path else ""
-        items = mpd_client.lsinfo(current_path)
+        cached_path, items = mpd_cache["library"]
+        if cached_path != current_path:
+            # 取得待ち
+            library_items = []
+            draw.text((0, y_pos), "読み込み中…", font=font, fill=255)
+            return
 
         library_items = []
 
@@ -400,7 +2227,7 @@ def draw_library_screen(draw):
                 library_items.append({"type": "file", "name": title, "path": item['file']})
 
         # リスト表示
-        visible_lines = 6
+        visible_lines = layout.list_lines
 
         if len(library_items) > 0:
             # スクロール調整
@@ -429,55 +2256,51 @@ def draw_library_screen(draw):
 
                 # カーソル位置は反転表示
                 if idx == library_cursor:
-                    draw.rectangle((0, y_pos, 124, y_pos + 7), outline=255, fill=255)
+                    draw.rectangle((0, y_pos, layout.cursor_right, y_pos + layout.row - 1), outline=255, fill=255)
                     draw.text((0, y_pos), line_text, font=font, fill=0)
                 else:
                     draw.text((0, y_pos), line_text, font=font, fill=255)
 
-                y_pos += 8
+                y_pos += layout.row
 
             # スクロールバー
             if len(library_items) > visible_lines:
-                bar_height = 48
+                bar_height = layout.list_bottom - layout.list_top
                 thumb_height = max(3, int((visible_lines / len(library_items)) * bar_height))
                 thumb_pos = int((library_scroll / (len(library_items) - visible_lines)) * (bar_height - thumb_height))
 
-                draw.rectangle((125, 8, 127, 56), outline=255, fill=0)
-                draw.rectangle((125, 8 + thumb_pos, 127, 8 + thumb_pos + thumb_height), outline=255, fill=255)
+                top = layout.list_top + thumb_pos
+                draw.rectangle((layout.scrollbar_x, layout.list_top, layout.right, layout.list_bottom), outline=layout.dim, fill=0)
+                draw.rectangle((layout.scrollbar_x, top, layout.right, top + thumb_height), outline=255, fill=255)
         else:
             draw.text((0, y_pos), "項目がありません", font=font, fill=255)
 
     except Exception as e:
-        mpd_connected = False  # 接続リセット（次回再接続）
         draw.text((0, 0), "MPD接続エラー", font=font, fill=255)
-        draw.text((0, 8), str(e), font=font, fill=255)
-
-def draw_system_menu(draw):
-    """システムメニューを描画"""
-    global menu_cursor
-    
-    menu_items = ["シャットダウン", "再起動"]
-    
-    y_pos = 8
-    for i, item in enumerate(menu_items):
-        if i == menu_cursor:
-            draw.rectangle((0, y_pos, 127, y_pos + 7), outline=255, fill=255)
+        draw.text((0, layout.row), str(e), font=font, fill=255)
+
+def draw_system_menu(draw, cursor):
+    """システムメニューを描画（cursorがNoneならカーソルなし）"""
+    y_pos = layout.list_top
+    for i, item in enumerate(SYSTEM_MENU_ITEMS):
+        if i == cursor:
+            draw.rectangle(list_row_rect(i), outline=255, fill=255)
             draw.text((0, y_pos), item, font=font, fill=0)
         else:
             draw.text((0, y_pos), item, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
 
-def draw_queue_menu(draw):
+def draw_queue_menu(draw, cursor):
     """再生キューメニューを描画（オーバーレイ）"""
-    global queue_menu_cursor
-    
-    menu_items = ["移動", "今すぐ再生", "削除"]
-    
+    draw_overlay_menu(draw, QUEUE_MENU_ITEMS, cursor)
+
+def draw_overlay_menu(draw, menu_items, cursor):
+    """中央にオーバーレイメニューを描画"""
     # 中央にメニューを表示
-    menu_width = 80
-    menu_height = len(menu_items) * 8 + 8
-    menu_x = (128 - menu_width) // 2
-    menu_y = (64 - menu_height) // 2
+    menu_width = layout.overlay_width
+    menu_height = (len(menu_items) + 1) * layout.row
+    menu_x = layout.overlay_x
+    menu_y = (layout.height - menu_height) // 2
     
     # 背景
     draw.rectangle((menu_x, menu_y, menu_x + menu_width, menu_y + menu_height), outline=255, fill=0)
@@ -486,50 +2309,422 @@ def draw_queue_menu(draw):
     # メニュー項目
     y_pos = menu_y + 4
     for i, item in enumerate(menu_items):
-        if i == queue_menu_cursor:
-            draw.rectangle((menu_x + 4, y_pos, menu_x + menu_width - 4, y_pos + 7), outline=255, fill=255)
+        if i == cursor:
+            draw.rectangle(overlay_row_rect(len(menu_items), i), outline=255, fill=255)
             draw.text((menu_x + 6, y_pos), item, font=font, fill=0)
         else:
             draw.text((menu_x + 6, y_pos), item, font=font, fill=255)
-        y_pos += 8
+        y_pos += layout.row
+
+def enqueue_genre():
+    """一括追加で選択中のジャンル（一覧が未取得ならNone）"""
+    genres = mpd_cache["genres"]
+    if not genres:
+        return None
+    return genres[enqueue_genre_index % len(genres)]
+
+def enqueue_menu_items():
+    """一括追加の設定画面の項目"""
+    if enqueue_mode == ENQUEUE_GENRE:
+        genre = enqueue_genre()
+        genre_text = f"ジャンル[{genre if genre is not None else '…'}]"
+    else:
+        genre_text = "ジャンル[-]"
+    count_text = "曲数[すべて]" if enqueue_mode == ENQUEUE_ALL else f"曲数[{ENQUEUE_COUNTS[enqueue_count_index]}]"
+    return [f"モード[{ENQUEUE_MODE_NAMES[enqueue_mode]}]", genre_text, count_text, "キューに追加", "置き換えて再生"]
+
+def draw_enqueue_menu(draw):
+    """一括追加の設定画面を描画（左右で値を変更）"""
+    draw.text((0, 0), "[一括追加]", font=font, fill=255)
+    y_pos = layout.list_top
+    for i, item in enumerate(enqueue_menu_items()):
+        if i == enqueue_cursor:
+            draw.rectangle((0, y_pos, layout.right, y_pos + layout.row - 1), outline=255, fill=255)
+            draw.text((0, y_pos), item, font=font, fill=0)
+        else:
+            draw.text((0, y_pos), item, font=font, fill=255)
+        y_pos += layout.row
+
+def draw_enqueue_progress(draw):
+    """一括追加の進捗を描画"""
+    job = enqueue_job
+    draw.text((0, 0), "[一括追加]", font=font, fill=255)
+    y_pos = layout.list_top
+    title = ENQUEUE_MODE_NAMES[job.mode]
+    if job.mode == ENQUEUE_GENRE:
+        title += f" {job.genre}"
+    draw.text((0, y_pos), title, font=font, fill=layout.dim)
+    y_pos += layout.row
+
+    if job.total is None:
+        draw.text((0, y_pos), "選曲中…", font=font, fill=255)
+    else:
+        draw.text((0, y_pos), f"{job.added}/{job.total}曲", font=font, fill=255)
+    y_pos += layout.row
+
+    # 進捗バー
+    if job.total:
+        progress = int(job.added / job.total * (layout.width - 1))
+        draw.rectangle((0, y_pos, layout.right, y_pos + 2), outline=layout.dim, fill=0)
+        draw.rectangle((0, y_pos, progress, y_pos + 2), outline=255, fill=255)
+    y_pos += layout.row
+
+    if job.state == "running":
+        message = "追加中…"
+    elif job.state == "done":
+        message = "完了" if not job.skipped else f"完了（{job.skipped}曲失敗）"
+    elif job.state == "cancelled":
+        message = "中止しました"
+    else:
+        message = "エラー: " + (job.error or "")
+    draw.text((0, y_pos), message, font=font, fill=255)
 
-def draw_screen():
-    """画面を描画"""
-    global state, start
+    guide = "決定: 中止" if job.running() else "決定: 再生キューへ"
+    draw.text((0, layout.height - layout.row), guide, font=font, fill=layout.dim)
 
-    # 画面描画前に接続確認（スクリーンセーバー以外）
-    if state != STATE_OFF:
-        connect_mpd()
+def enqueue_deps():
+    job = enqueue_job
+    if job is None:
+        return None
+    return (id(job), job.total, job.added, job.state)
 
-    with canvas(device) as draw:
-        if state == STATE_OFF:
-            # 空白画面を描画（OLED保護のため完全に消さない）
-            pass
-        elif state == STATE_PLAYING:
-            draw_playing_screen(draw)
-        elif state == STATE_QUEUE:
-            draw_queue_screen(draw)
-        elif state == STATE_MAIN_MENU:
+def playlist_length():
+    """閲覧中のプレイリストの曲数（不明な場合はNone）"""
+    name, length = mpd_cache["playlist_length"]
+    return length if name == playlist_name else None
+
+def draw_playlist_view(draw):
+    """保存済みプレイリストの内容を描画"""
+    global playlist_cursor, playlist_scroll
+
+    try:
+        if mpd_cache["error"]:
+            raise Exception(mpd_cache["error"])
+
+        length = playlist_length()
+        if length is not None and playlist_cursor >= length:
+            playlist_cursor = max(0, length - 1)
+
+        # ヘッダー: プレイリスト名と位置
+        count = "?" if length is None else str(length)
+        draw.text((0, 0), f"# {playlist_name} ({playlist_cursor + 1}/{count})", font=font, fill=255)
+        y_pos = layout.list_top
+
+        if length == 0:
+            draw.text((0, y_pos), "項目がありません", font=font, fill=255)
+            return
+
+        visible_lines = layout.list_lines
+        if playlist_cursor < playlist_scroll:
+            playlist_scroll = playlist_cursor
+        if playlist_cursor >= playlist_scroll + visible_lines:
+            playlist_scroll = playlist_cursor - visible_lines + 1
+
+        name, start, items = mpd_cache["playlist_window"]
+        for i in range(visible_lines):
+            idx = playlist_scroll + i
+            if length is not None and idx >= length:
+                break
+
+            if name == playlist_name and start <= idx < start + len(items):
+                item = items[idx - start]
+                line_text = "@ " + item.get('title', os.path.basename(item['file']))
+            else:
+                line_text = "  …"  # 取得待ち
+
+            if idx == playlist_cursor:
+                draw.rectangle((0, y_pos, layout.cursor_right, y_pos + layout.row - 1), outline=255, fill=255)
+                draw.text((0, y_pos), line_text, font=font, fill=0)
+            else:
+                draw.text((0, y_pos), line_text, font=font, fill=255)
+            y_pos += layout.row
+
+        # スクロールバー（曲数が分かっている場合のみ）
+        if length is not None and length > visible_lines:
+            bar_height = layout.list_bottom - layout.list_top
+            thumb_height = max(3, int((visible_lines / length) * bar_height))
+            thumb_pos = int((playlist_scroll / (length - visible_lines)) * (bar_height - thumb_height))
+
+            top = layout.list_top + thumb_pos
+            draw.rectangle((layout.scrollbar_x, layout.list_top, layout.right, layout.list_bottom), outline=layout.dim, fill=0)
+            draw.rectangle((layout.scrollbar_x, top, layout.right, top + thumb_height), outline=255, fill=255)
+
+    except Exception as e:
+        draw.text((0, 0), "MPD接続エラー", font=font, fill=255)
+        draw.text((0, layout.row), str(e), font=font, fill=255)
+
+def playlist_selected_file():
+    """カーソル位置の曲のファイル（未取得の場合はNone）"""
+    name, start, items = mpd_cache["playlist_window"]
+    if name == playlist_name and start <= playlist_cursor < start + len(items):
+        return items[playlist_cursor - start]['file']
+    return None
+
+def playlist_view_deps():
+    return (playlist_name, id(mpd_cache["playlist_window"]), playlist_length(), playlist_cursor)
+
+# 各画面が描画に使う状態（前回描画時と同じなら描画とSPI転送を省略）
+def playing_deps():
+    status = effective_status()
+    current = mpd_cache["current"]
+    return (current.get('id'), current.get('title'), current.get('artist'), current.get('album'),
+            current.get('track'), current.get('duration'), status.get('state'), status.get('volume'),
+            int(float(status.get('elapsed', 0))), time.strftime("%H:%M"), playing_view)
+
+def queue_deps():
+    status = effective_status()
+    return (mpd_cache["playlist_version"], status.get('songid'), status.get('repeat'),
+            status.get('single'), status.get('random'), queue_cursor, queue_moving_from)
+
+def library_deps():
+    return (tuple(library_path), id(mpd_cache["library"]), library_cursor)
+
+SCREEN_DEPS = {
+    STATE_OFF: lambda: (),
+    STATE_PLAYING: playing_deps,
+    STATE_QUEUE: queue_deps,
+    STATE_MAIN_MENU: lambda: (menu_cursor, playing_view, enqueue_deps()),
+    STATE_LIBRARY: library_deps,
+    STATE_SYSTEM: lambda: (menu_cursor,),
+    STATE_QUEUE_MENU: lambda: (queue_deps(), queue_menu_cursor),
+    STATE_PLAYLIST_VIEW: playlist_view_deps,
+    STATE_PLAYLIST_MENU: lambda: (playlist_view_deps(), playlist_menu_cursor),
+    STATE_ENQUEUE_MENU: lambda: (enqueue_menu_items(), enqueue_cursor),
+    STATE_ENQUEUE_PROGRESS: enqueue_deps,
+    STATE_SERVER_SELECT: server_select_deps,
+}
+
+# 描画済みのメニュー画面（カーソルなしの画面全体と、行ごとにカーソルを反転表示したページ）
+MENU_SCREEN_CACHE_SIZE = 8
+menu_screens = {}  # キー -> MenuScreen
+shown_menu = None  # パネルに表示中の (MenuScreen, カーソル位置)
+
+class MenuScreen:
+    """カーソル以外が変わらない画面の描画結果"""
+
+    def __init__(self, base, rows):
+        self.base = base  # カーソルなしのフレームバッファ
+        self.rows = rows  # 行ごとの (カーソル範囲, 先頭ページ, 最終ページ, 反転表示したページのデータ)
+
+def draw_badges(draw, busy, profiling):
+    """右上のビジー表示とステータス欄のプロファイル採取中の表示"""
+    if busy:
+        draw.rectangle((layout.busy_x, 0, layout.right, layout.row - 1), outline=255, fill=255)
+        draw.text((layout.busy_x, 0), "…", font=font, fill=0)
+    if profiling:
+        x, y = layout.profile_playing if state == STATE_PLAYING else layout.profile_status
+        draw.rectangle((x, y, x + layout.profile_width - 1, y + layout.row - 1), outline=255, fill=255)
+        draw.text((x + 1, y), PROFILE_BADGE, font=font, fill=0)
+
+def menu_screen(badges):
+    """表示中の画面がメニューなら (キー, 描画関数, カーソル範囲の一覧, カーソル位置)
+
+    描画関数はカーソルなしで描く。キーが同じ間は描画済みのものを使う。
+    フレームバッファがページ形式でない（グレースケールの）パネルでは使わない。
+    """
+    if not isinstance(framebuffer, PageCanvas):
+        return None
+    if state == STATE_MAIN_MENU:
+        items = main_menu_items()
+
+        def render(draw):
             draw.text((0, 0), "[メインメニュー]", font=font, fill=255)
-            draw_main_menu(draw)
-        elif state == STATE_LIBRARY:
-            draw_library_screen(draw)
-        elif state == STATE_SYSTEM:
+            draw_main_menu(draw, None)
+        return (("main", badges, tuple(items)), render, [list_row_rect(i) for i in range(len(items))], menu_cursor)
+    if state == STATE_SYSTEM:
+        def render(draw):
             draw.text((0, 0), "[システム]", font=font, fill=255)
-            draw_system_menu(draw)
-        elif state == STATE_QUEUE_MENU:
+            draw_system_menu(draw, None)
+        return (("system", badges), render, [list_row_rect(i) for i in range(len(SYSTEM_MENU_ITEMS))], menu_cursor)
+    if state == STATE_QUEUE_MENU:
+        def render(draw):
             draw_queue_screen(draw)
-            draw_queue_menu(draw)
+            draw_queue_menu(draw, None)
+        key = ("queue", badges, id(mpd_cache), mpd_cache["error"], queue_deps())
+        return (key, render, [overlay_row_rect(len(QUEUE_MENU_ITEMS), i) for i in range(len(QUEUE_MENU_ITEMS))],
+                queue_menu_cursor)
+    if state == STATE_PLAYLIST_MENU:
+        def render(draw):
+            draw_playlist_view(draw)
+            draw_overlay_menu(draw, PLAYLIST_MENU_ITEMS, None)
+        key = ("playlist", badges, id(mpd_cache), mpd_cache["error"], playlist_view_deps())
+        return (key, render, [overlay_row_rect(len(PLAYLIST_MENU_ITEMS), i) for i in range(len(PLAYLIST_MENU_ITEMS))],
+                playlist_menu_cursor)
+    return None
+
+def build_menu_screen(render, rects, badges):
+    """メニュー画面をカーソルなしで描画し、行ごとの反転表示を作る"""
+    draw = framebuffer
+    draw.clear()
+    render(draw)
+    draw_badges(draw, *badges)
+    base = bytes(draw.buffer)
+    rows = []
+    for rect in rects:
+        first_page = rect[1] // 8
+        last_page = rect[3] // 8
+        draw.invert(rect)
+        rows.append((rect, first_page, last_page, bytes(draw.view[first_page * draw.width:(last_page + 1) * draw.width])))
+        draw.invert(rect)
+    return MenuScreen(base, rows)
+
+def show_menu_screen(key, render, rects, cursor):
+    """メニュー画面を表示（同じ画面でカーソルだけが動いた場合は2行分だけ書き換えて転送）"""
+    global shown_menu
+    screen = menu_screens.get(key)
+    if screen is None:
+        if len(menu_screens) >= MENU_SCREEN_CACHE_SIZE:
+            menu_screens.pop(next(iter(menu_screens)))  # 古いものから捨てる
+        screen = menu_screens[key] = build_menu_screen(render, rects, key[1])
+
+    w = framebuffer.width
+    view = framebuffer.view
+    if cursor is not None and not 0 <= cursor < len(screen.rows):
+        cursor = None
+    if shown_menu is not None and shown_menu[0] is screen:
+        # 前のカーソル行を戻し、新しいカーソル行を反転表示にして、その範囲だけ転送
+        changed = []
+        if shown_menu[1] is not None:
+            row = screen.rows[shown_menu[1]]
+            start = row[1] * w
+            end = (row[2] + 1) * w
+            view[start:end] = screen.base[start:end]
+            changed.append(row)
+        if cursor is not None:
+            row = screen.rows[cursor]
+            view[row[1] * w:(row[2] + 1) * w] = row[3]
+            changed.append(row)
+        if changed:
+            first_page = min(row[1] for row in changed)
+            last_page = max(row[2] for row in changed)
+            x0 = min(row[0][0] for row in changed)
+            x1 = max(row[0][2] for row in changed)
+            flush_pages(first_page, last_page, x0, x1 - x0 + 1)
+    else:
+        view[:] = screen.base
+        if cursor is not None:
+            rect, first_page, last_page, inverted = screen.rows[cursor]
+            view[first_page * w:(last_page + 1) * w] = inverted
+        flush_pages()
+    shown_menu = (screen, cursor)
+
+def draw_screen():
+    """画面を描画"""
+    global state, start, last_frame_fingerprint, playing_header_valid, shown_menu
+
+    t0 = time.perf_counter()
+    busy = state != STATE_OFF and mpd_is_busy()
+    badges = (busy, state != STATE_OFF and profiling())
+    fingerprint = (state, mpd_cache["error"], badges, SCREEN_DEPS[state]())
+    if fingerprint == last_frame_fingerprint:
+        trace("frame", state=state, skipped=True)
+        return
+    last_frame_fingerprint = fingerprint
+
+    # メニューは描画済みの画面を使い、カーソル行だけを差し替える
+    menu = menu_screen(badges)
+    if menu is not None:
+        show_menu_screen(*menu)
+        playing_header_valid = False
+        trace("frame", state=state, dt=round((time.perf_counter() - t0) * 1000, 2))
+        return
+    shown_menu = None
+
+    draw = framebuffer
+    if state != STATE_PLAYING:
+        # 再生中画面以外は毎回全体を描き直す
+        draw.clear()
+        playing_header_valid = False
+    if state == STATE_OFF:
+        # 空白画面を描画（OLED保護のため完全に消さない）
+        pass
+    elif state == STATE_PLAYING:
+        draw_playing_screen(draw)
+    elif state == STATE_QUEUE:
+        draw_queue_screen(draw)
+    elif state == STATE_MAIN_MENU:
+        draw.text((0, 0), "[メインメニュー]", font=font, fill=255)
+        draw_main_menu(draw, menu_cursor)
+    elif state == STATE_LIBRARY:
+        draw_library_screen(draw)
+    elif state == STATE_SYSTEM:
+        draw.text((0, 0), "[システム]", font=font, fill=255)
+        draw_system_menu(draw, menu_cursor)
+    elif state == STATE_QUEUE_MENU:
+        draw_queue_screen(draw)
+        draw_queue_menu(draw, queue_menu_cursor)
+    elif state == STATE_PLAYLIST_VIEW:
+        draw_playlist_view(draw)
+    elif state == STATE_PLAYLIST_MENU:
+        draw_playlist_view(draw)
+        draw_overlay_menu(draw, PLAYLIST_MENU_ITEMS, playlist_menu_cursor)
+    elif state == STATE_ENQUEUE_MENU:
+        draw_enqueue_menu(draw)
+    elif state == STATE_ENQUEUE_PROGRESS:
+        draw_enqueue_progress(draw)
+    elif state == STATE_SERVER_SELECT:
+        draw_server_select(draw)
+
+    # MPDの応答待ちが続いている場合は右上にビジー表示（最後に取得した状態のまま）
+    if any(badges):
+        draw_badges(draw, *badges)
+        if busy:
+            playing_header_valid = False  # ビジー表示は再生中画面の上部に重なる
+    flush_pages()
+    trace("frame", state=state, dt=round((time.perf_counter() - t0) * 1000, 2))
+
+# MPD操作（表示は即座に更新し、MPDへは連続操作をまとめて送る）
+def change_volume(delta):
+    """ボリュームを変更"""
+    status = effective_status()
+    if not status:
+        # 状態を未取得（画面オフからの復帰直後など）: MPDの現在値に直接加える
+        def step(client):
+            volume = int(client.status().get('volume', -1))
+            if volume >= 0:
+                client.setvol(max(0, min(100, volume + delta)))
+        mpd_command(step)
+        return
+    volume = int(status.get('volume', -1))
+    if volume < 0:
+        return  # ミキサーなし
+    optimistic_set('volume', str(max(0, min(100, volume + delta))))
+
+def toggle_pause():
+    """再生/一時停止を切り替え"""
+    if effective_status().get('state') == 'play':
+        optimistic_set('state', 'pause')
+    else:
+        optimistic_set('state', 'play')
+
+def cycle_repeat():
+    """リピート切り替え（オフ → 全体 → トラック → オフ）"""
+    status = effective_status()
+    if status.get('repeat', '0') == '0':
+        # オフ → 全体
+        optimistic_set('repeat', '1')
+        optimistic_set('single', '0')
+    elif status.get('single', '0') == '0':
+        # 全体 → トラック
+        optimistic_set('single', '1')
+    else:
+        # トラック → オフ
+        optimistic_set('repeat', '0')
+        optimistic_set('single', '0')
+
+def toggle_random():
+    """シャッフル切り替え"""
+    optimistic_set('random', '0' if effective_status().get('random', '0') == '1' else '1')
 
 # ボタンハンドラ
 def btn1_pressed():
     """BTN1: 再生中画面・再生キュー切り替え"""
-    global state, menu_cursor, queue_cursor, queue_moving_from, start, need_redraw, last_song_id, last_playing_image
+    global state, menu_cursor, queue_cursor, queue_moving_from, start, need_redraw, last_song_id, playing_header_valid
 
     if not debounce(BTN1_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰
@@ -546,7 +2741,7 @@ def btn1_pressed():
         queue_cursor = -2  # カーソルをリピート行に初期化
         # 再生中画面を離れるのでキャッシュをクリア
         last_song_id = None
-        last_playing_image = None
+        playing_header_valid = False
     elif state == STATE_QUEUE:
         state = STATE_PLAYING
     else:
@@ -555,12 +2750,12 @@ def btn1_pressed():
 
 def btn2_pressed():
     """BTN2: ライブラリへ移動"""
-    global state, library_path, library_cursor, library_scroll, queue_moving_from, start, need_redraw, last_song_id, last_playing_image
+    global state, library_path, library_cursor, library_scroll, queue_moving_from, start, need_redraw, last_song_id, playing_header_valid
 
     if not debounce(BTN2_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰
@@ -572,10 +2767,23 @@ def btn2_pressed():
     if queue_moving_from >= 0:
         queue_moving_from = -1
 
+    # プレイリスト閲覧中はメニュー → 一覧 → ライブラリの順に戻る
+    if state == STATE_PLAYLIST_MENU:
+        state = STATE_PLAYLIST_VIEW
+        return
+    if state == STATE_PLAYLIST_VIEW:
+        state = STATE_LIBRARY
+        return
+
+    # 一括追加の画面からはメインメニューへ戻る（追加は続ける）
+    if state == STATE_ENQUEUE_MENU or state == STATE_ENQUEUE_PROGRESS or state == STATE_SERVER_SELECT:
+        state = STATE_MAIN_MENU
+        return
+
     # 再生中画面を離れる場合はキャッシュをクリア
     if state == STATE_PLAYING:
         last_song_id = None
-        last_playing_image = None
+        playing_header_valid = False
 
     # ライブラリに移動
     state = STATE_LIBRARY
@@ -585,12 +2793,12 @@ def btn2_pressed():
 
 def btn3_pressed():
     """BTN3: メインメニュー"""
-    global state, menu_cursor, queue_moving_from, start, need_redraw, last_song_id, last_playing_image
+    global state, menu_cursor, queue_moving_from, start, need_redraw, last_song_id, playing_header_valid
 
     if not debounce(BTN3_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰
@@ -605,42 +2813,30 @@ def btn3_pressed():
     # 再生中画面を離れる場合はキャッシュをクリア
     if state == STATE_PLAYING:
         last_song_id = None
-        last_playing_image = None
+        playing_header_valid = False
 
     state = STATE_MAIN_MENU
     menu_cursor = 0
 
 def joystick_up():
     """ジョイスティック上"""
-    global state, menu_cursor, library_cursor, queue_cursor, queue_menu_cursor, start, need_redraw
+    global state, menu_cursor, library_cursor, queue_cursor, queue_menu_cursor, playlist_cursor, playlist_menu_cursor, enqueue_cursor, server_cursor, start, need_redraw
 
     if not debounce(JS_U_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰（ボリューム上げ）
     if state == STATE_OFF:
         state = STATE_PLAYING
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            volume = int(status.get('volume', 50))
-            mpd_client.setvol(min(100, volume + 5))
-        except:
-            pass
+        change_volume(5)
         return
 
     if state == STATE_PLAYING:
         # ボリューム上げ
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            volume = int(status.get('volume', 50))
-            mpd_client.setvol(min(100, volume + 5))
-        except:
-            pass
+        change_volume(5)
     elif state == STATE_MAIN_MENU or state == STATE_SYSTEM:
         if menu_cursor > 0:
             menu_cursor -= 1
@@ -653,41 +2849,41 @@ def joystick_up():
     elif state == STATE_QUEUE_MENU:
         if queue_menu_cursor > 0:
             queue_menu_cursor -= 1
+    elif state == STATE_PLAYLIST_VIEW:
+        if playlist_cursor > 0:
+            playlist_cursor -= 1
+    elif state == STATE_PLAYLIST_MENU:
+        if playlist_menu_cursor > 0:
+            playlist_menu_cursor -= 1
+    elif state == STATE_ENQUEUE_MENU:
+        if enqueue_cursor > 0:
+            enqueue_cursor -= 1
+    elif state == STATE_SERVER_SELECT:
+        if server_cursor > 0:
+            server_cursor -= 1
 
 def joystick_down():
     """ジョイスティック下"""
-    global state, menu_cursor, library_cursor, queue_cursor, queue_menu_cursor, start, need_redraw
+    global state, menu_cursor, library_cursor, queue_cursor, queue_menu_cursor, playlist_cursor, playlist_menu_cursor, enqueue_cursor, server_cursor, start, need_redraw
 
     if not debounce(JS_D_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰（ボリューム下げ）
     if state == STATE_OFF:
         state = STATE_PLAYING
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            volume = int(status.get('volume', 50))
-            mpd_client.setvol(max(0, volume - 5))
-        except:
-            pass
+        change_volume(-5)
         return
 
     if state == STATE_PLAYING:
         # ボリューム下げ
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            volume = int(status.get('volume', 50))
-            mpd_client.setvol(max(0, volume - 5))
-        except:
-            pass
+        change_volume(-5)
     elif state == STATE_MAIN_MENU or state == STATE_SYSTEM:
         # メニュー項目数を動的に取得
-        max_items = 4 if state == STATE_MAIN_MENU else 2
+        max_items = len(main_menu_items()) if state == STATE_MAIN_MENU else 2
         if menu_cursor < max_items - 1:
             menu_cursor += 1
     elif state == STATE_LIBRARY:
@@ -698,8 +2894,40 @@ def joystick_down():
         if queue_cursor < max_cursor:
             queue_cursor += 1
     elif state == STATE_QUEUE_MENU:
-        if queue_menu_cursor < 2:
+        if queue_menu_cursor < len(QUEUE_MENU_ITEMS) - 1:
             queue_menu_cursor += 1
+    elif state == STATE_PLAYLIST_VIEW:
+        length = playlist_length()
+        if length is None or playlist_cursor < length - 1:
+            playlist_cursor += 1
+    elif state == STATE_PLAYLIST_MENU:
+        if playlist_menu_cursor < len(PLAYLIST_MENU_ITEMS) - 1:
+            playlist_menu_cursor += 1
+    elif state == STATE_ENQUEUE_MENU:
+        if enqueue_cursor < len(enqueue_menu_items()) - 1:
+            enqueue_cursor += 1
+    elif state == STATE_SERVER_SELECT:
+        if server_cursor < len(mpd_servers) - 1:
+            server_cursor += 1
+
+def enqueue_adjust(direction):
+    """一括追加の設定画面で、カーソル行の値を切り替え"""
+    global enqueue_mode, enqueue_count_index, enqueue_genre_index
+    if enqueue_cursor == 0:
+        enqueue_mode = (enqueue_mode + direction) % len(ENQUEUE_MODE_NAMES)
+    elif enqueue_cursor == 1 and enqueue_mode == ENQUEUE_GENRE and mpd_cache["genres"]:
+        enqueue_genre_index = (enqueue_genre_index + direction) % len(mpd_cache["genres"])
+    elif enqueue_cursor == 2:
+        enqueue_count_index = max(0, min(len(ENQUEUE_COUNTS) - 1, enqueue_count_index + direction))
+
+def playlist_jump(direction):
+    """プレイリスト閲覧中のジャンプ（全体の1/10、曲数不明時は1ページ分）"""
+    global playlist_cursor
+    length = playlist_length()
+    step = max(layout.list_lines, length // 10) if length else PLAYLIST_PAGE
+    playlist_cursor = max(0, playlist_cursor + direction * step)
+    if length:
+        playlist_cursor = min(playlist_cursor, length - 1)
 
 def joystick_left():
     """ジョイスティック左"""
@@ -708,26 +2936,22 @@ def joystick_left():
     if not debounce(JS_L_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰（前の曲）
     if state == STATE_OFF:
         state = STATE_PLAYING
-        try:
-            connect_mpd()
-            mpd_client.previous()
-        except:
-            pass
+        mpd_command(lambda client: client.previous())
         return
 
     if state == STATE_PLAYING:
         # 前の曲
-        try:
-            connect_mpd()
-            mpd_client.previous()
-        except:
-            pass
+        mpd_command(lambda client: client.previous())
+    elif state == STATE_PLAYLIST_VIEW:
+        playlist_jump(-1)
+    elif state == STATE_ENQUEUE_MENU:
+        enqueue_adjust(-1)
 
 def joystick_right():
     """ジョイスティック右"""
@@ -736,62 +2960,42 @@ def joystick_right():
     if not debounce(JS_R_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰（次の曲）
     if state == STATE_OFF:
         state = STATE_PLAYING
-        try:
-            connect_mpd()
-            mpd_client.next()
-        except:
-            pass
+        mpd_command(lambda client: client.next())
         return
 
     if state == STATE_PLAYING:
         # 次の曲
-        try:
-            connect_mpd()
-            mpd_client.next()
-        except:
-            pass
+        mpd_command(lambda client: client.next())
+    elif state == STATE_PLAYLIST_VIEW:
+        playlist_jump(1)
+    elif state == STATE_ENQUEUE_MENU:
+        enqueue_adjust(1)
 
 def joystick_pressed():
     """ジョイスティック押し込み（決定）"""
-    global state, menu_cursor, library_cursor, library_path, library_scroll, queue_cursor, queue_menu_cursor, queue_moving_from, start, need_redraw
+    global state, menu_cursor, library_cursor, library_path, library_scroll, queue_cursor, queue_menu_cursor, queue_moving_from, playlist_name, playlist_cursor, playlist_scroll, playlist_menu_cursor, enqueue_cursor, server_cursor, start, need_redraw
 
     if not debounce(JS_P_PIN):
         return
 
-    start = time.time()
+    start = clock()
     need_redraw = True
 
     # スクリーンセーバーから復帰（再生/一時停止）
     if state == STATE_OFF:
         state = STATE_PLAYING
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            if status['state'] == 'play':
-                mpd_client.pause(1)
-            else:
-                mpd_client.play()
-        except:
-            pass
+        toggle_pause()
         return
 
     if state == STATE_PLAYING:
         # 再生/一時停止
-        try:
-            connect_mpd()
-            status = mpd_client.status()
-            if status['state'] == 'play':
-                mpd_client.pause(1)
-            else:
-                mpd_client.play()
-        except:
-            pass
+        toggle_pause()
     elif state == STATE_MAIN_MENU:
         if menu_cursor == 0:
             state = STATE_PLAYING
@@ -805,6 +3009,22 @@ def joystick_pressed():
         elif menu_cursor == 3:
             state = STATE_SYSTEM
             menu_cursor = 0
+        elif menu_cursor == 4:
+            cycle_playing_view()
+            state = STATE_PLAYING
+        elif menu_cursor == 5:
+            # 追加中なら進捗を表示
+            if enqueue_job is not None and enqueue_job.running():
+                state = STATE_ENQUEUE_PROGRESS
+            else:
+                state = STATE_ENQUEUE_MENU
+                enqueue_cursor = 0
+        elif menu_cursor == 6:
+            state = STATE_SERVER_SELECT
+            server_cursor = mpd_servers.index(active_server)
+    elif state == STATE_SERVER_SELECT:
+        switch_server(mpd_servers[server_cursor])
+        state = STATE_PLAYING
     elif state == STATE_LIBRARY:
         if library_cursor < len(library_items):
             item = library_items[library_cursor]
@@ -817,68 +3037,38 @@ def joystick_pressed():
                 library_cursor = 0
                 library_scroll = 0
             elif item['type'] == 'file':
-                try:
-                    connect_mpd()
-                    mpd_client.clear()
-                    mpd_client.add(item['path'])
-                    mpd_client.play()
-                    state = STATE_PLAYING
-                except:
-                    pass
+                path = item['path']
+
+                def play_file(client):
+                    client.clear()
+                    client.add(path)
+                    client.play()
+                mpd_command(play_file)
+                state = STATE_PLAYING
             elif item['type'] == 'playlist':
-                try:
-                    connect_mpd()
-                    mpd_client.clear()
-                    mpd_client.load(item['path'])
-                    mpd_client.play()
-                    state = STATE_PLAYING
-                except:
-                    pass
+                # 内容を閲覧（キューは置き換えない）。前回開いたときの取得結果は使わない
+                clear_playlist_cache(mpd_cache)
+                state = STATE_PLAYLIST_VIEW
+                playlist_name = item['path']
+                playlist_cursor = 0
+                playlist_scroll = 0
     elif state == STATE_QUEUE:
         # 移動モード中の場合は、選択した位置に挿入
         if queue_moving_from >= 0:
             if queue_cursor >= 0:
-                try:
-                    connect_mpd()
-                    # queue_moving_fromからqueue_cursorの上に移動
-                    mpd_client.move(queue_moving_from, queue_cursor)
-                    queue_moving_from = -1
-                except:
-                    queue_moving_from = -1
+                # queue_moving_fromからqueue_cursorの上に移動
+                src, dst = queue_moving_from, queue_cursor
+                mpd_command(lambda client: client.move(src, dst))
+                queue_moving_from = -1
             return
 
         # リピート/シャッフル切り替え
         if queue_cursor == -2:
             # リピート切り替え
-            try:
-                connect_mpd()
-                status = mpd_client.status()
-                current_repeat = status.get('repeat', '0')
-                current_single = status.get('single', '0')
-                
-                # オフ → 全体 → トラック → オフ
-                if current_repeat == '0':
-                    # オフ → 全体
-                    mpd_client.repeat(1)
-                    mpd_client.single(0)
-                elif current_single == '0':
-                    # 全体 → トラック
-                    mpd_client.single(1)
-                else:
-                    # トラック → オフ
-                    mpd_client.repeat(0)
-                    mpd_client.single(0)
-            except:
-                pass
+            cycle_repeat()
         elif queue_cursor == -1:
             # シャッフル切り替え
-            try:
-                connect_mpd()
-                status = mpd_client.status()
-                current_random = status.get('random', '0')
-                mpd_client.random(0 if current_random == '1' else 1)
-            except:
-                pass
+            toggle_random()
         else:
             # 通常のキュー項目
             state = STATE_QUEUE_MENU
@@ -890,28 +3080,167 @@ def joystick_pressed():
             state = STATE_QUEUE
         elif queue_menu_cursor == 1:
             # 今すぐ再生
-            try:
-                connect_mpd()
-                mpd_client.play(queue_cursor)
-                state = STATE_PLAYING
-            except:
-                pass
+            pos = queue_cursor
+            mpd_command(lambda client: client.play(pos))
+            state = STATE_PLAYING
         elif queue_menu_cursor == 2:
             # 削除
-            try:
-                connect_mpd()
-                mpd_client.delete(queue_cursor)
-                if queue_cursor >= len(queue_items) - 1:
-                    queue_cursor = max(0, len(queue_items) - 2)
-                state = STATE_QUEUE
-            except:
-                pass
+            pos = queue_cursor
+            mpd_command(lambda client: client.delete(pos))
+            if queue_cursor >= len(queue_items) - 1:
+                queue_cursor = max(0, len(queue_items) - 2)
+            state = STATE_QUEUE
+    elif state == STATE_PLAYLIST_VIEW:
+        state = STATE_PLAYLIST_MENU
+        playlist_menu_cursor = 0
+    elif state == STATE_PLAYLIST_MENU:
+        name = playlist_name
+        pos = playlist_cursor
+        if playlist_menu_cursor == 0:
+            # カーソル位置から末尾までで置き換えて再生
+            def play_from(client):
+                client.clear()
+                client.load(name, f"{pos}:")
+                client.play(0)
+            mpd_command(play_from)
+            state = STATE_PLAYING
+        elif playlist_menu_cursor == 1:
+            # カーソル位置から末尾までをキューに追加
+            mpd_command(lambda client: client.load(name, f"{pos}:"))
+            state = STATE_PLAYLIST_VIEW
+        elif playlist_menu_cursor == 2:
+            # カーソル位置の曲をキューに追加
+            path = playlist_selected_file()
+            if path is not None:
+                mpd_command(lambda client: client.add(path))
+            state = STATE_PLAYLIST_VIEW
+        elif playlist_menu_cursor == 3:
+            # プレイリスト全体で置き換えて再生
+            def play_playlist(client):
+                client.clear()
+                client.load(name)
+                client.play()
+            mpd_command(play_playlist)
+            state = STATE_PLAYING
+    elif state == STATE_ENQUEUE_MENU:
+        if enqueue_cursor >= ENQUEUE_START_ROW:
+            genre = enqueue_genre()
+            if enqueue_mode != ENQUEUE_GENRE or genre is not None:
+                start_enqueue(enqueue_mode, ENQUEUE_COUNTS[enqueue_count_index], genre,
+                              replace=enqueue_cursor > ENQUEUE_START_ROW)
+                state = STATE_ENQUEUE_PROGRESS
+    elif state == STATE_ENQUEUE_PROGRESS:
+        if enqueue_job.running():
+            enqueue_job.cancel.set()
+        else:
+            state = STATE_QUEUE
+            queue_cursor = -2
     elif state == STATE_SYSTEM:
         if menu_cursor == 0:
             os.system("sudo shutdown -h now")
         elif menu_cursor == 1:
             os.system("sudo reboot")
 
+def input_handler(name, func):
+    """入力イベントを記録してからハンドラを呼び出す"""
+    def handler():
+        trace("input", name=name)
+        watch_begin("input:" + name, name)
+        try:
+            func()
+        finally:
+            watch_end("input:" + name)
+    return handler
+
+PROFILE_CHORD_WINDOW = 0.5  # もう一方を押してからこの秒数以内に押したら同時押し
+button_pressed_at = {}  # BTN1/BTN3 -> 最後に押した時刻
+
+def chord_handler(button, name, func, other):
+    """BTN1/BTN3の押したときのハンドラ
+
+    もう一方を押したままPROFILE_CHORD_WINDOW秒以内に押した場合は同時押し（プロファイルの
+    開始・終了）とし、後から押したボタンの操作は行わない（先に押したボタンの操作は済んでいる）。
+    """
+    handler = input_handler(name, func)
+
+    def pressed():
+        now = time.monotonic()
+        button_pressed_at[button] = now
+        if other.is_pressed and now - button_pressed_at.get(other, 0.0) <= PROFILE_CHORD_WINDOW:
+            toggle_profile()
+            return
+        handler()
+    return pressed
+
+# 入力名とハンドラの対応（記録ログの再生にも使用）
+INPUT_HANDLERS = {
+    "btn1": btn1_pressed,
+    "btn2": btn2_pressed,
+    "btn3": btn3_pressed,
+    "left": joystick_left,
+    "right": joystick_right,
+    "up": joystick_up,
+    "down": joystick_down,
+    "press": joystick_pressed,
+}
+
+def run_replay(path):
+    """記録ログを再生し、入力ごとのフレーム完了までのレイテンシとMPD往復回数を出力
+
+    レイテンシは手元での処理・描画の時間に、その間のMPD往復の記録時の所要時間を加えたもの。
+    """
+    global mpd_client_factory, clock, state, need_redraw
+
+    with open(path, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+
+    replay_time = [0.0]
+    clock = lambda: replay_time[0]
+    stub = StubMPDClient(events, clock)
+    mpd_client_factory = lambda: stub
+
+    state = STATE_PLAYING
+
+    pending = []  # フレーム待ちの入力: (時刻, 名前, 開始時刻, MPD往復回数, MPD所要時間の合計)
+    latencies = []
+    print("t\tinput\tstate\tlatency_ms\tmpd_ms\tmpd_roundtrips")
+    for ev in events:
+        replay_time[0] = ev["t"]
+        if ev["ev"] == "input":
+            pending.append((ev["t"], ev["name"], time.perf_counter(), stub.calls, stub.mpd_ms))
+            INPUT_HANDLERS[ev["name"]]()
+        elif ev["ev"] == "saver":
+            state = STATE_OFF
+        elif ev["ev"] == "tick":
+            pending.append((ev["t"], "(tick)", time.perf_counter(), stub.calls, stub.mpd_ms))
+            request_refresh()
+        elif ev["ev"] == "frame":
+            if not pending:
+                pending.append((ev["t"], "(frame)", time.perf_counter(), stub.calls, stub.mpd_ms))
+            # メインループと同様に、操作後は状態を取り直してから描画
+            flush_optimistic()
+            if need_redraw:
+                need_redraw = False
+                request_refresh()
+            # コマンドはワーカーを使わずここで実行する（応答を選ぶ時刻がフレームの時刻に定まる）
+            mpd_run_pending()
+            draw_screen()
+            now = time.perf_counter()
+            for t, name, t0, calls, mpd_ms in pending:
+                # MPDの応答は待たずに返るので、記録時の往復時間を加える
+                mpd_ms = stub.mpd_ms - mpd_ms
+                latency = (now - t0) * 1000 + mpd_ms
+                if not name.startswith("("):
+                    latencies.append(latency)
+                print(f"{t:.3f}\t{name}\t{state}\t{latency:.2f}\t{mpd_ms:.2f}\t{stub.calls - calls}")
+            pending = []
+
+    if latencies:
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"# inputs={len(latencies)} mean={sum(latencies) / len(latencies):.2f}ms "
+              f"p95={p95:.2f}ms max={latencies[-1]:.2f}ms mpd_roundtrips={stub.calls}")
+
 # GPIO設定
 btn1 = Button(BTN1_PIN, pull_up=True, bounce_time=0.01)
 btn2 = Button(BTN2_PIN, pull_up=True, bounce_time=0.01)
@@ -923,49 +3252,113 @@ js_down = Button(JS_D_PIN, pull_up=True, bounce_time=0.01)
 js_press = Button(JS_P_PIN, pull_up=True, bounce_time=0.01)
 
 # イベントハンドラ設定
-btn1.when_pressed = btn1_pressed
-btn2.when_pressed = btn2_pressed
-btn3.when_pressed = btn3_pressed
-js_left.when_pressed = joystick_left
-js_right.when_pressed = joystick_right
-js_up.when_pressed = joystick_up
-js_down.when_pressed = joystick_down
-js_press.when_pressed = joystick_pressed
+btn1.when_pressed = chord_handler(btn1, "btn1", btn1_pressed, btn3)
+btn2.when_pressed = input_handler("btn2", btn2_pressed)
+btn3.when_pressed = chord_handler(btn3, "btn3", btn3_pressed, btn1)
+js_left.when_pressed = input_handler("left", joystick_left)
+js_right.when_pressed = input_handler("right", joystick_right)
+js_up.when_pressed = input_handler("up", joystick_up)
+js_down.when_pressed = input_handler("down", joystick_down)
+js_press.when_pressed = input_handler("press", joystick_pressed)
+
+# 再生履歴の読み込みとMPDワーカー起動（再生時はフレームごとに再生処理の中で実行）
+load_history()
+if not args.replay:
+    for server in mpd_servers:
+        threading.Thread(target=mpd_worker, args=(server,), name=f"mpd-worker-{server.name}", daemon=True).start()
+
+# 各サーバーの状態をidleで待ち受け（記録・再生時はMPDとの通信を再現できなくなるため行わない）
+if not args.record and not args.replay:
+    for server in mpd_servers:
+        threading.Thread(target=idle_watch, args=(server,), name=f"mpd-idle-{server.name}", daemon=True).start()
+
+# 記録ログの再生（ヘッドレスで実行して終了）
+if args.replay:
+    run_replay(args.replay)
+    sys.exit(0)
+
+# 入力とMPD通信の記録開始
+if args.record:
+    trace_file = open(args.record, "w", encoding="utf-8", buffering=1)
+    trace_start = time.time()
+    trace("meta", host=active_server.host, port=active_server.port)
+
+# SIGUSR1でプロファイルの開始・終了（systemctl kill -s USR1 mpd-client）
+signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_profile())
+
+# 停止監視とsystemdへの起動完了通知
+open_stall_log(args.stall_log)
+watch_begin("main", "startup")
+threading.Thread(target=stall_watchdog, name="stall-watchdog", daemon=True).start()
+sd_notify("READY=1")
 
 # メインループ
 try:
-    connect_mpd()
     state = STATE_PLAYING
     last_update_time = time.time()
+    last_busy = False
+    last_visualizer = False
 
     while True:
         current_time = time.time()
+        watch_begin("main", "loop")
 
         # スクリーンセーバー
         if state != STATE_OFF and (current_time - start) > SCREEN_SAVER:
             state = STATE_OFF
             need_redraw = True
+            mpd_cancel("refresh")
+            trace("saver")
 
         # 画面更新の条件判定
         should_update = False
 
-        # 再生中画面は1秒ごとに自動更新
+        # 再生中画面は1秒ごとに状態を取り直す（取得できたら再描画）
         if state == STATE_PLAYING and (current_time - last_update_time) >= 1.0:
-            should_update = True
+            request_refresh()
+            retry_lyrics()
+            trace("tick")
             last_update_time = current_time
 
-        # 操作があった場合は即座に更新
+        # 操作があった場合は即座に更新し、状態も取り直す
         if need_redraw:
             should_update = True
             need_redraw = False
             last_update_time = current_time
+            request_refresh()
+
+        # 落ち着いた操作をMPDへ送る
+        flush_optimistic()
+
+        # MPDから新しい状態が届いた
+        if data_ready:
+            should_update = True
+            data_ready = False
+
+        # ビジー表示の切り替え
+        busy = mpd_is_busy()
+        if busy != last_busy:
+            should_update = True
+            last_busy = busy
 
         # 画面更新
         if should_update:
             draw_screen()
 
-        # 短いスリープで次のイベントをチェック
-        time.sleep(0.1)
+        # ビジュアライザは変化した列だけを高いフレームレートで更新
+        active = visualizer_active()
+        if active != last_visualizer:
+            sync_visualizer(active)
+            last_visualizer = active
+        if active:
+            visualizer_frame()
+            time.sleep(1.0 / VISUALIZER_FPS)
+        else:
+            # 歌詞は行が変わったときだけ下部を書き換え
+            if lyrics_active() and not should_update:
+                lyrics_frame()
+            # 短いスリープで次のイベントをチェック
+            time.sleep(0.1)
 
 except KeyboardInterrupt:
     print("\nStopped by user")